@@ -0,0 +1,327 @@
+import argparse
+import csv
+import logging
+import queue
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Thread
+
+from reading import CHANNELS
+
+log = logging.getLogger('middleware.archive')
+
+# Archived tables: their columns (name, type) and the columns they are partitioned by.
+# Types are pyarrow type names, so pyarrow is only imported by the writer thread and the reader.
+TABLES = {
+    'readings': {
+        'columns': [
+            ('block_id', 'string'),  # None for readings kept locally by the dead-band filter
+            ('timestamp', 'timestamp'),
+            *((channel, 'float64') for channel in CHANNELS),
+            ('ttn_time', 'timestamp'),
+            ('rssi', 'int16'),
+            ('snr', 'float32'),
+            ('frequency', 'int64'),
+            ('gateway_id', 'dictionary')
+        ],
+        'partitions': ('date', 'device_id'),
+        'time_column': 'timestamp'
+    },
+    'confirmations': {
+        'columns': [
+            ('block_id', 'string'),
+            ('ttn_time', 'timestamp'),
+            ('confirmation_time', 'timestamp'),
+            ('response_time', 'float64')
+        ],
+        'partitions': ('date', 'device_id'),
+        'time_column': 'confirmation_time'
+    },
+    'metrics': {
+        'columns': [
+            ('timestamp', 'timestamp'),
+            ('operation', 'dictionary'),
+            ('original_size', 'int32'),
+            ('encrypted_size', 'int32'),
+            ('encryption_time', 'float64'),
+            ('transmission_time', 'float64'),
+            ('total_time', 'float64')
+        ],
+        'partitions': ('date',),
+        'time_column': 'timestamp'
+    }
+}
+
+# Channel columns of iota_data.csv, in CHANNELS order
+CSV_CHANNELS = ('AHT10 Temperature', 'AHT10 Humidity', 'DS18B20 Temperature', 'Light level', 'Soil moisture')
+
+
+# Arrow type of a column type name
+def _arrow_type(pa, name):
+    """Arrow type of a column type name"""
+    if name == 'timestamp':
+        return pa.timestamp('us', tz='UTC')
+    if name == 'dictionary':
+        return pa.dictionary(pa.int32(), pa.string())
+    return getattr(pa, name)()
+
+
+# Arrow schema of a table
+def table_schema(pa, table):
+    """Arrow schema of a table"""
+    return pa.schema([(name, _arrow_type(pa, kind)) for name, kind in TABLES[table]['columns']])
+
+
+# Partition schema of a table (hive layout, e.g. date=2024-05-01/device_id=sensor-1)
+def partition_schema(pa, table):
+    """Partition schema of a table"""
+    return pa.schema([(name, pa.string()) for name in TABLES[table]['partitions']])
+
+
+# UTC date partition of an epoch time
+def _date(epoch):
+    """UTC date partition of an epoch time"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+
+# UTC datetime of an epoch time, or None
+def _utc(epoch):
+    """UTC datetime of an epoch time, or None"""
+    return None if epoch is None else datetime.fromtimestamp(epoch, timezone.utc)
+
+
+# Background writer rolling readings, confirmations and metrics into partitioned Parquet files
+class ParquetArchive:
+    def __init__(self, directory='archive', flush_rows=10000, flush_interval=300.0, min_rows=1000, max_age=6 * 3600.0):
+        self.directory = Path(directory)
+        self.flush_rows = flush_rows  # Rows buffered per partition before a file is written
+        self.flush_interval = flush_interval  # Seconds between checks of the partitions below flush_rows
+        self.min_rows = min_rows  # Rows a partition needs before a check writes it, so files are not tiny
+        self.max_age = max_age  # Seconds a partition below min_rows may stay buffered
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._run, name='archive', daemon=True)
+        self._thread.start()
+
+    # Archive a stored reading
+    def add_reading(self, block_id, reading, ttn_time):
+        """Archive a stored reading"""
+        self._queue.put(('readings', (_date(reading.timestamp), reading.device_id), (
+            block_id, _utc(reading.timestamp), *reading.values, _utc(ttn_time),
+            reading.rssi, reading.snr, int(reading.frequency) if reading.frequency else None, reading.gateway_id
+        )))
+
+    # Archive a block confirmation
+    def add_confirmation(self, block_id, device_id, ttn_time, confirmation_time):
+        """Archive a block confirmation"""
+        self._queue.put(('confirmations', (_date(confirmation_time), device_id), (
+            block_id, _utc(ttn_time), _utc(confirmation_time), confirmation_time - ttn_time
+        )))
+
+    # Archive an encryption metrics row
+    def add_metric(self, operation, original_size, encrypted_size, encryption_time, transmission_time, total_time):
+        """Archive an encryption metrics row"""
+        now = time.time()
+        self._queue.put(('metrics', (_date(now),), (
+            _utc(now), operation, original_size, encrypted_size, encryption_time, transmission_time, total_time
+        )))
+
+    # Write what is buffered and stop the writer
+    def close(self, timeout=None):
+        """Write what is buffered and stop the writer"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    # Buffer rows per table and partition, writing a file when one is full or ready at a periodic check
+    def _run(self):
+        """Buffer rows per table and partition, writing a file when one is full or ready at a periodic check"""
+        buffers = {}  # (table, partition) -> rows
+        opened = {}  # (table, partition) -> monotonic time of its first buffered row
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                table, partition, row = item
+                rows = buffers.setdefault((table, partition), [])
+                opened.setdefault((table, partition), time.monotonic())
+                rows.append(row)
+                if len(rows) >= self.flush_rows:
+                    self._write(table, partition, buffers.pop((table, partition)))
+                    del opened[(table, partition)]
+            if time.monotonic() - last_flush >= self.flush_interval:
+                for key in [key for key in buffers if self._ready(key, buffers[key], opened[key])]:
+                    self._write(*key, buffers.pop(key))
+                    del opened[key]
+                last_flush = time.monotonic()
+        for key in list(buffers):
+            self._write(*key, buffers.pop(key))
+
+    # Whether a partition below flush_rows should be written at a periodic check
+    def _ready(self, key, rows, opened):
+        """Whether a partition below flush_rows should be written at a periodic check"""
+        # Small partitions stay open, unless their day is over (no more rows will come) or they are too old
+        return (len(rows) >= self.min_rows
+                or key[1][0] < _date(time.time())
+                or time.monotonic() - opened >= self.max_age)
+
+    # Write the rows of one partition to a new Parquet file
+    def _write(self, table, partition, rows):
+        """Write the rows of one partition to a new Parquet file"""
+        try:
+            write_partition(self.directory, table, partition, rows)
+        except Exception as e:
+            log.error("Error archiving %d %s rows: %s", len(rows), table, e)
+
+
+# Write rows (tuples in column order) of one partition to a new Parquet file
+def write_partition(directory, table, partition, rows):
+    """Write rows (tuples in column order) of one partition to a new Parquet file"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = table_schema(pa, table)
+    columns = list(zip(*rows))
+    batch = pa.Table.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+    path = Path(directory) / table
+    for name, value in zip(TABLES[table]['partitions'], partition):
+        path /= f"{name}={value}"
+    path.mkdir(parents=True, exist_ok=True)
+    pq.write_table(batch, path / f"part-{time.time_ns()}.parquet", compression='zstd')
+
+
+# Read an archived table, pushing time, device and column selection down to the files
+def read(directory, table, columns=None, since=None, until=None, devices=None):
+    """Read an archived table, pushing time, device and column selection down to the files"""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        Path(directory) / table, format='parquet',
+        partitioning=ds.partitioning(partition_schema(pa, table), flavor='hive'))
+    time_column = ds.field(TABLES[table]['time_column'])
+    conditions = []
+    # Date partitions outside the range are skipped without opening their files,
+    # and row groups outside it are skipped using their min/max statistics
+    if since is not None:
+        conditions += [ds.field('date') >= _date(since), time_column >= pa.scalar(_utc(since), pa.timestamp('us', 'UTC'))]
+    if until is not None:
+        conditions += [ds.field('date') <= _date(until), time_column <= pa.scalar(_utc(until), pa.timestamp('us', 'UTC'))]
+    if devices and 'device_id' in TABLES[table]['partitions']:
+        conditions.append(ds.field('device_id').isin(list(devices)))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+# Export archived readings as delta/XOR-compressed series, one file per day and device
+def export_series(directory, out_dir, since=None, until=None, devices=None):
+    """Export archived readings as delta/XOR-compressed series, one file per day and device"""
+    import pandas as pd
+    from tscodec import encode_series
+
+    df = read(directory, 'readings', columns=['timestamp', *CHANNELS, 'date', 'device_id'],
+              since=since, until=until, devices=devices).to_pandas()
+    files = 0
+    for (date, device_id), group in df.sort_values('timestamp').groupby(['date', 'device_id'], observed=True):
+        epochs = (group['timestamp'] - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+        path = Path(out_dir) / f"date={date}" / f"{device_id}.tsz"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(encode_series(epochs.tolist(), [group[channel].tolist() for channel in CHANNELS]))
+        files += 1
+    return files
+
+
+# Epoch time of an ISO timestamp from the CSV files, or None
+def _epoch(text):
+    """Epoch time of an ISO timestamp from the CSV files, or None"""
+    return datetime.fromisoformat(text).timestamp() if text else None
+
+
+# Roll existing iota_data.csv and encryption_metrics.csv files into the archive
+def import_csv(directory, data_file=None, metrics_file=None):
+    """Roll existing iota_data.csv and encryption_metrics.csv files into the archive"""
+    counts = {}
+    if data_file:
+        readings, confirmations = {}, {}
+        # Newer runs append confirmations to iota_confirmations.csv instead of updating iota_data.csv
+        confirmed_at = {}
+        confirmations_file = Path(data_file).with_name(Path(data_file).name.replace('iota_data', 'iota_confirmations'))
+        if confirmations_file != Path(data_file) and confirmations_file.exists():
+            with confirmations_file.open(newline='') as f:
+                confirmed_at = {row['Block ID']: row['Confirmation time'] for row in csv.DictReader(f)}
+        with open(data_file, newline='') as f:
+            for row in csv.DictReader(f):
+                captured = _epoch(row['Timestamp'])
+                ttn_time = _epoch(row['TTN time'])
+                device_id = row['Device ID']
+                values = [float(row[c]) if row.get(c) else None for c in CSV_CHANNELS]
+                readings.setdefault((_date(captured), device_id), []).append(
+                    (row['Block ID'], _utc(captured), *values, _utc(ttn_time), None, None, None, None))
+                if row['Block ID'] in confirmed_at:
+                    row['Confirmed'], row['Confirmation time'] = 'True', confirmed_at[row['Block ID']]
+                if row['Confirmed'].lower() == 'true' and row['Confirmation time'] and ttn_time:
+                    confirmed = _epoch(row['Confirmation time'])
+                    confirmations.setdefault((_date(confirmed), device_id), []).append(
+                        (row['Block ID'], _utc(ttn_time), _utc(confirmed), confirmed - ttn_time))
+        for table, partitions in (('readings', readings), ('confirmations', confirmations)):
+            for partition, rows in partitions.items():
+                write_partition(directory, table, partition, rows)
+            counts[table] = sum(map(len, partitions.values()))
+    if metrics_file:
+        metrics = {}
+        with open(metrics_file, newline='') as f:
+            for row in csv.DictReader(f):
+                stamp = _epoch(row['Timestamp'])
+                metrics.setdefault((_date(stamp),), []).append((
+                    _utc(stamp), row['Operation'], int(row['Original size (bytes)']),
+                    int(row['Encrypted size (bytes)']), float(row['Encryption time (s)']),
+                    float(row['Transmission time (s)']), float(row['Total time (s)'])))
+        for partition, rows in metrics.items():
+            write_partition(directory, 'metrics', partition, rows)
+        counts['metrics'] = sum(map(len, metrics.values()))
+    return counts
+
+
+# Import CSV results into the archive or query it
+def main():
+    """Import CSV results into the archive or query it"""
+    parser = argparse.ArgumentParser(description='Partitioned Parquet archive of the middleware results')
+    parser.add_argument('directory', help='Archive directory (ARCHIVE_DIR)')
+    parser.add_argument('--import-data', help='iota_data.csv file to roll into the archive')
+    parser.add_argument('--import-metrics', help='encryption_metrics.csv file to roll into the archive')
+    parser.add_argument('--table', choices=list(TABLES), default='readings', help='Table to query')
+    parser.add_argument('--columns', help='Comma-separated columns to read (default: all)')
+    parser.add_argument('--since', help='ISO start time')
+    parser.add_argument('--until', help='ISO end time')
+    parser.add_argument('--device', action='append', help='Device to read (repeatable)')
+    parser.add_argument('--export-series', metavar='DIR', help='Write the selected readings as compressed series (tscodec)')
+    args = parser.parse_args()
+
+    if args.import_data or args.import_metrics:
+        for table, count in import_csv(args.directory, args.import_data, args.import_metrics).items():
+            print(f"{table}: {count} rows archived")
+        return
+
+    if args.export_series:
+        files = export_series(args.directory, args.export_series, _epoch(args.since), _epoch(args.until), args.device)
+        print(f"{files} series written to {args.export_series}")
+        return
+
+    start = time.perf_counter()
+    result = read(
+        args.directory, args.table,
+        columns=args.columns.split(',') if args.columns else None,
+        since=_epoch(args.since), until=_epoch(args.until), devices=args.device)
+    print(f"{result.num_rows} rows, {result.nbytes} bytes in {time.perf_counter() - start:.3f}s")
+    print(result.slice(0, 10).to_pandas().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import base64
+import json
+import time
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+from reading import SensorReading
+
+UPLINK = {
+    'end_device_ids': {'device_id': 'sensor-001'},
+    'uplink_message': {
+        'decoded_payload': {'v0': 21.4, 'v1': 56.2, 'v2': 19.75, 'v3': 612, 'v4': 43},
+        'rx_metadata': [{'rssi': -87, 'snr': 8.25, 'gateway_ids': {'gateway_id': 'gateway-01'}}],
+        'settings': {'frequency': '868100000'}
+    }
+}
+
+
+# Convert a UTF-8 string to a hex string
+def utf8_to_hex(utf8_data):
+    """Convert a UTF-8 string to a hex string"""
+    return '0x' + utf8_data.encode('utf-8').hex()
+
+
+# Previous path: nested dict, two json.dumps calls and str/bytes round trips
+def previous_path(cipher, payload):
+    """Previous path: nested dict, two json.dumps calls and str/bytes round trips"""
+    sensor_data = {
+        "deviceId": payload["end_device_ids"]["device_id"],
+        "timestamp": datetime.now().isoformat(),
+        "measurements": {
+            "aht10_temperature": payload["uplink_message"]["decoded_payload"]["v0"],
+            "aht10_humidity": payload["uplink_message"]["decoded_payload"]["v1"],
+            "ds18b20_temperature": payload["uplink_message"]["decoded_payload"]["v2"],
+            "light_level": payload["uplink_message"]["decoded_payload"]["v3"],
+            "soil_moisture": payload["uplink_message"]["decoded_payload"]["v4"]
+        },
+        "metadata": {
+            "rssi": payload["uplink_message"]["rx_metadata"][0]["rssi"],
+            "snr": payload["uplink_message"]["rx_metadata"][0]["snr"],
+            "frequency": payload["uplink_message"]["settings"]["frequency"],
+            "gateway_id": payload["uplink_message"]["rx_metadata"][0]["gateway_ids"]["gateway_id"]
+        }
+    }
+    json_str = json.dumps(sensor_data)
+    len(json_str.encode())
+    encrypted_data = cipher.encrypt(json_str.encode())
+    original_size = len(json.dumps(sensor_data).encode())
+    return utf8_to_hex(base64.b64encode(encrypted_data).decode()), original_size
+
+
+# Current path: one serialization, sizes from the buffer, bytes-only encoding
+def current_path(cipher, payload):
+    """Current path: one serialization, sizes from the buffer, bytes-only encoding"""
+    data = SensorReading.from_uplink(payload).to_bytes()
+    encrypted_data = cipher.encrypt(data)
+    return '0x' + base64.b64encode(encrypted_data).hex(), len(data)
+
+
+# Microseconds per message of a payload path
+def measure(path, cipher, count):
+    """Microseconds per message of a payload path"""
+    start = time.process_time()
+    for _ in range(count):
+        path(cipher, UPLINK)
+    return (time.process_time() - start) / count * 1e6
+
+
+# Compare the CPU time per message of the previous and current payload paths
+def main():
+    """Compare the CPU time per message of the previous and current payload paths"""
+    parser = argparse.ArgumentParser(description='Benchmark the per-message payload path of send_to_iota')
+    parser.add_argument('--count', type=int, default=50000)
+    args = parser.parse_args()
+
+    cipher = Fernet(Fernet.generate_key())
+    # Both paths must put the same document on the ledger
+    for path in (previous_path, current_path):
+        data, _ = path(cipher, UPLINK)
+        document = json.loads(cipher.decrypt(base64.b64decode(bytes.fromhex(data[2:]))))
+        assert set(document) == {'deviceId', 'timestamp', 'measurements', 'metadata'}
+
+    previous = measure(previous_path, cipher, args.count)
+    current = measure(current_path, cipher, args.count)
+    print(f"Previous path: {previous:.1f} us/message")
+    print(f"Current path:  {current:.1f} us/message ({100 * (1 - current / previous):.0f}% less CPU)")
+
+
+if __name__ == "__main__":
+    main()
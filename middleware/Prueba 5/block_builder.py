@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# IOTA clients of the current worker process, one per node
+_worker_clients = {}
+
+
+# Build (with local proof of work) and post a block from a worker process
+def _build_and_post(node_url, options):
+    """Build (with local proof of work) and post a block from a worker process"""
+    client = _worker_clients.get(node_url)
+    if client is None:
+        from iota_sdk import Client
+        # One PoW thread per process: parallelism comes from the number of processes
+        client = Client(nodes=[node_url], local_pow=True, pow_worker_count=1)
+        _worker_clients[node_url] = client
+    block_id, _ = client.build_and_post_block(**options)
+    return block_id
+
+
+# Process pool shared by all nodes for CPU-bound block building
+class BlockBuildPool:
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        # Spawned workers do not inherit the parent's IOTA client threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    # Client-like handle posting to one node through the pool
+    def client_for(self, node_url):
+        """Client-like handle posting to one node through the pool"""
+        return PooledBlockClient(self, node_url)
+
+    # Stop the worker processes
+    def shutdown(self):
+        """Stop the worker processes"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Drop-in for Client.build_and_post_block that runs in the process pool
+class PooledBlockClient:
+    def __init__(self, pool, node_url):
+        self.pool = pool
+        self.node_url = node_url
+
+    # Submit the block to the pool without waiting
+    def submit(self, **options):
+        """Submit the block to the pool without waiting"""
+        return self.pool.executor.submit(_build_and_post, self.node_url, options)
+
+    # Build and post a block in a worker process, returning [block id, None]
+    def build_and_post_block(self, **options):
+        """Build and post a block in a worker process, returning [block id, None]"""
+        return [self.submit(**options).result(), None]
@@ -0,0 +1,87 @@
+import argparse
+import bisect
+import csv
+import hashlib
+from pathlib import Path
+
+# Result files of each shard merged for reporting, sorted by their timestamp column
+MERGED_FILES = ('iota_data.csv', 'iota_confirmations.csv', 'encryption_metrics.csv', 'filtered_data.csv')
+
+
+# Stable 64-bit hash of a string
+def _hash(value):
+    """Stable 64-bit hash of a string"""
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], 'big')
+
+
+# Consistent-hash ring assigning devices to shards
+class HashRing:
+    def __init__(self, shard_count, replicas=100, name='shard'):
+        # Virtual nodes spread each shard over the ring, so adding one moves only ~1/N of the devices.
+        # Rings with different names (e.g. shards and their workers) split devices independently.
+        points = sorted((_hash(f"{name}-{shard}#{i}"), shard) for shard in range(shard_count) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    # Shard owning a device
+    def shard_for(self, device_id):
+        """Shard owning a device"""
+        index = bisect.bisect(self._hashes, _hash(device_id)) % len(self._hashes)
+        return self._shards[index]
+
+
+# Device id of a TTN uplink topic (v3/{app}@ttn/devices/{device_id}/up)
+def topic_device(topic):
+    """Device id of a TTN uplink topic"""
+    parts = topic.split('/')
+    return parts[3] if len(parts) > 4 else None
+
+
+# Merge one result file of every shard directory into a single file
+def merge_file(name, shard_dirs, out_dir):
+    """Merge one result file of every shard directory into a single file"""
+    header, rows = None, []
+    for shard_dir in shard_dirs:
+        path = Path(shard_dir) / name
+        if not path.exists():
+            continue
+        with path.open('r', newline='') as f:
+            reader = csv.reader(f)
+            shard_header = next(reader, None)
+            if shard_header is None:
+                continue
+            if header is None:
+                header = shard_header
+            elif shard_header != header:
+                raise ValueError(f"{path} has a different layout than the other shards")
+            rows.extend(reader)
+    if header is None:
+        return 0
+    time_column = header.index('Timestamp') if 'Timestamp' in header else None
+    if time_column is not None:
+        rows.sort(key=lambda row: row[time_column])  # ISO timestamps sort chronologically as text
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with (out_dir / name).open('w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return len(rows)
+
+
+# Merge the results of every shard for report.py
+def main():
+    """Merge the results of every shard for report.py"""
+    parser = argparse.ArgumentParser(description='Merge the result files of the middleware shards')
+    parser.add_argument('shards', nargs='+', help='Shard data directories (DATA_DIR of each process)')
+    parser.add_argument('--out', default='merged', help='Directory for the merged files')
+    args = parser.parse_args()
+
+    out_dir = Path(args.out)
+    for name in MERGED_FILES:
+        count = merge_file(name, args.shards, out_dir)
+        if count:
+            print(f"{name}: {count} rows from {len(args.shards)} shards")
+
+
+if __name__ == "__main__":
+    main()
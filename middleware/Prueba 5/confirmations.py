@@ -0,0 +1,118 @@
+import csv
+import logging
+import os
+import threading
+from pathlib import Path
+
+log = logging.getLogger('middleware.confirmations')
+
+# Journal line kinds
+ADDED = 'A'  # A,block_id,ttn_time,node,priority,device_id
+CLOSED = 'C'  # C,block_id
+
+
+# Posted block waiting for confirmation
+class PendingBlock:
+    __slots__ = ('block_id', 'ttn_time', 'node', 'priority', 'device_id')
+
+    def __init__(self, block_id, ttn_time, node, priority, device_id):
+        self.block_id = block_id
+        self.ttn_time = ttn_time  # Capture time, so confirmation latency still counts from the uplink
+        self.node = node  # Node the block was posted to, or None
+        self.priority = priority
+        self.device_id = device_id
+
+
+# Journal of blocks waiting for confirmation, so a crash or restart does not forget them
+class ConfirmationJournal:
+    def __init__(self, path='confirmation_journal.csv', fsync=False, compact_bytes=1 << 20):
+        self.path = Path(path)
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes  # Rewrite with only the pending blocks once the file is this large
+        self._pending = {}  # block_id -> PendingBlock
+        self._lock = threading.Lock()
+        self._file = None
+        self._compacted_size = 0  # Size right after the last rewrite
+        self._load()
+        self._rewrite()
+
+    # Read the blocks left pending by a previous run
+    def _load(self):
+        """Read the blocks left pending by a previous run"""
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open('r', newline='') as f:
+                for row in csv.reader(f):
+                    if row[:1] == [ADDED] and len(row) == 6:
+                        _, block_id, ttn_time, node, priority, device_id = row
+                        self._pending[block_id] = PendingBlock(
+                            block_id, float(ttn_time), node or None, int(priority), device_id)
+                    elif row[:1] == [CLOSED] and len(row) == 2:
+                        self._pending.pop(row[1], None)
+                    # Anything else is a torn last line after a crash
+        except Exception as e:
+            log.error("Error loading confirmation journal: %s", e)
+
+    # Journal line of a pending block
+    @staticmethod
+    def _row(block):
+        """Journal line of a pending block"""
+        return [ADDED, block.block_id, block.ttn_time, block.node or '', block.priority, block.device_id]
+
+    # Replace the journal with only the pending blocks and reopen it for appending
+    def _rewrite(self):
+        """Replace the journal with only the pending blocks and reopen it for appending"""
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', newline='') as f:
+            csv.writer(f).writerows(self._row(block) for block in self._pending.values())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self._file:
+            self._file.close()
+        self._file = self.path.open('a', newline='')
+        self._writer = csv.writer(self._file)
+        self._compacted_size = self._file.tell()
+
+    # Write a line and make it durable
+    def _write(self, row):
+        """Write a line and make it durable"""
+        self._writer.writerow(row)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    # Record a posted block that still needs confirmation
+    def add(self, block_id, ttn_time, node, priority, device_id):
+        """Record a posted block that still needs confirmation"""
+        block = PendingBlock(block_id, ttn_time, node, priority, device_id)
+        with self._lock:
+            self._pending[block_id] = block
+            self._write(self._row(block))
+
+    # Mark a block as finished (confirmed or given up)
+    def close(self, block_id):
+        """Mark a block as finished (confirmed or given up)"""
+        with self._lock:
+            if self._pending.pop(block_id, None) is None:
+                return
+            self._write([CLOSED, block_id])
+            # Twice the live size at least, so a large backlog is not rewritten on every confirmation
+            if self._file.tell() >= max(self.compact_bytes, 2 * self._compacted_size):
+                try:
+                    self._rewrite()
+                except Exception as e:
+                    log.error("Error compacting confirmation journal: %s", e)
+
+    # Blocks still waiting for confirmation, oldest capture first
+    def pending(self):
+        """Blocks still waiting for confirmation, oldest capture first"""
+        with self._lock:
+            return sorted(self._pending.values(), key=lambda block: block.ttn_time)
+
+    # Number of blocks waiting for confirmation
+    def depth(self):
+        """Number of blocks waiting for confirmation"""
+        return len(self._pending)
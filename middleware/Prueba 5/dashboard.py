@@ -0,0 +1,195 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>TTN to Tangle - live response times</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; margin-top: 1em; }
+td, th { border: 1px solid #ccc; padding: 4px 10px; text-align: right; }
+canvas { border: 1px solid #ccc; }
+</style>
+</head>
+<body>
+<h2>Response time: TTN to Tangle (live)</h2>
+<div id="summary"></div>
+<canvas id="chart" width="900" height="250"></canvas>
+<h3>Devices</h3>
+<table id="devices"><tr><th>Device</th><th>Uplinks/min</th><th>Last latency (s)</th></tr></table>
+<script>
+const history = [];
+const chart = document.getElementById('chart').getContext('2d');
+function draw() {
+  const w = chart.canvas.width, h = chart.canvas.height;
+  chart.clearRect(0, 0, w, h);
+  const max = Math.max(1, ...history.map(p => p.p99 || 0));
+  [['p50', '#1f77b4'], ['p90', '#ff7f0e'], ['p99', '#d62728']].forEach(([key, color]) => {
+    chart.strokeStyle = color;
+    chart.beginPath();
+    history.forEach((p, i) => {
+      const x = i * w / 300, y = h - (p[key] || 0) / max * (h - 10);
+      i ? chart.lineTo(x, y) : chart.moveTo(x, y);
+    });
+    chart.stroke();
+  });
+}
+const source = new EventSource('/dashboard/events');
+source.onmessage = (event) => {
+  const s = JSON.parse(event.data);
+  history.push(s.latency);
+  if (history.length > 300) history.shift();
+  document.getElementById('summary').textContent =
+    `p50 ${s.latency.p50 ?? '-'} s | p90 ${s.latency.p90 ?? '-'} s | p99 ${s.latency.p99 ?? '-'} s | ` +
+    `samples ${s.latency.count} | uplinks ${s.throughput.uplinks_per_s}/s | ` +
+    `confirmed ${s.throughput.confirmations_per_s}/s (last ${s.window_s}s)`;
+  // Device ids come from the uplinks, so cells are filled as text, never as markup
+  const table = document.getElementById('devices');
+  while (table.rows.length > 1) table.deleteRow(1);
+  Object.entries(s.devices).forEach(([d, v]) => {
+    const row = table.insertRow();
+    [d, v.rate_per_min, v.last_latency ?? '-'].forEach(value => {
+      row.insertCell().textContent = value;
+    });
+  });
+  draw();
+};
+</script>
+</body>
+</html>
+"""
+
+
+# Per-second event counts over a fixed window
+class _RateRing:
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self._seconds = [0] * window_seconds
+        self._counts = [0] * window_seconds
+
+    # Count one event at time `now`
+    def add(self, now):
+        """Count one event at time `now`"""
+        second = int(now)
+        slot = second % self.window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += 1
+
+    # Average events per second over the window
+    def rate(self, now):
+        """Average events per second over the window"""
+        oldest = int(now) - self.window
+        total = sum(c for s, c in zip(self._seconds, self._counts) if s > oldest)
+        return total / self.window
+
+
+# In-memory rolling windows feeding the live dashboard
+class RollingStats:
+    def __init__(self, window_seconds=300, max_samples=4096, device_half_life=60.0):
+        self.window_seconds = window_seconds
+        self.device_half_life = device_half_life
+        self._latencies = deque(maxlen=max_samples)  # (time, latency)
+        self._uplinks = _RateRing(window_seconds)
+        self._confirmations = _RateRing(window_seconds)
+        self._devices = {}  # device -> [decayed rate, last update, last latency]
+        self._lock = threading.Lock()
+
+    # Record an uplink received from TTN
+    def record_uplink(self, device_id):
+        """Record an uplink received from TTN"""
+        now = time.time()
+        with self._lock:
+            self._uplinks.add(now)
+            state = self._devices.get(device_id)
+            if state is None:
+                self._devices[device_id] = [1.0, now, None]
+            else:
+                state[0] = state[0] * self._decay(now - state[1]) + 1.0
+                state[1] = now
+
+    # Record a confirmed block and its response time
+    def record_confirmation(self, device_id, latency):
+        """Record a confirmed block and its response time"""
+        now = time.time()
+        with self._lock:
+            self._confirmations.add(now)
+            self._latencies.append((now, latency))
+            state = self._devices.get(device_id)
+            if state is not None:
+                state[2] = latency
+
+    # Exponential decay factor for the per-device rate
+    def _decay(self, elapsed):
+        """Exponential decay factor for the per-device rate"""
+        return math.pow(0.5, elapsed / self.device_half_life)
+
+    # Current percentiles, throughput and device rates
+    def snapshot(self):
+        """Current percentiles, throughput and device rates"""
+        now = time.time()
+        with self._lock:
+            latencies = sorted(l for t, l in self._latencies if now - t <= self.window_seconds)
+            uplink_rate = self._uplinks.rate(now)
+            confirmation_rate = self._confirmations.rate(now)
+            devices = {}
+            for device_id, (rate, updated, last_latency) in self._devices.items():
+                decayed = rate * self._decay(now - updated)
+                # Decayed count over the half-life, expressed per minute
+                per_min = decayed * math.log(2) / self.device_half_life * 60
+                devices[device_id] = {
+                    'rate_per_min': round(per_min, 2),
+                    'last_latency': None if last_latency is None else round(last_latency, 3)
+                }
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)], 3)
+
+        return {
+            'window_s': self.window_seconds,
+            'latency': {
+                'count': len(latencies),
+                'p50': percentile(0.50),
+                'p90': percentile(0.90),
+                'p99': percentile(0.99),
+                'max': round(latencies[-1], 3) if latencies else None
+            },
+            'throughput': {
+                'uplinks_per_s': round(uplink_rate, 3),
+                'confirmations_per_s': round(confirmation_rate, 3)
+            },
+            'devices': devices
+        }
+
+
+# Live dashboard page and event stream
+class Dashboard:
+    def __init__(self, stats, interval=1.0):
+        self.stats = stats
+        self.interval = interval
+
+    # HTTP route handler for the dashboard page
+    def handle_page(self, query):
+        """HTTP route handler for the dashboard page"""
+        return 200, 'text/html; charset=utf-8', DASHBOARD_HTML.encode()
+
+    # Server-sent events with a snapshot every interval
+    def events(self):
+        """Server-sent events with a snapshot every interval"""
+        while True:
+            yield json.dumps(self.stats.snapshot())
+            time.sleep(self.interval)
+
+    # Register the dashboard on a local server
+    def register(self, server):
+        """Register the dashboard on a local server"""
+        server.add_route('/dashboard', self.handle_page)
+        server.add_stream('/dashboard/events', self.events)
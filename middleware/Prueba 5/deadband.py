@@ -0,0 +1,53 @@
+import threading
+import time
+
+
+# Per-device, per-channel dead-band filter deciding which readings get anchored
+class DeadbandFilter:
+    def __init__(self, thresholds, heartbeat_every=0, max_interval=3600.0):
+        # thresholds: {"default": {channel: delta}, "<device_id>": {channel: delta}}
+        self.default = thresholds.get('default', {})
+        self.per_device = {k: v for k, v in thresholds.items() if k != 'default'}
+        self.heartbeat_every = heartbeat_every  # Anchor at least one of every N readings (0 disables)
+        self.max_interval = max_interval  # Anchor at least once every N seconds per device
+        self._state = {}  # device -> {'values', 'time', 'suppressed'}
+        self._lock = threading.Lock()
+
+    # Dead-band of each channel for a device
+    def thresholds_for(self, device_id):
+        """Dead-band of each channel for a device"""
+        return {**self.default, **self.per_device.get(device_id, {})}
+
+    # Decide whether a reading is anchored and why
+    def check(self, device_id, measurements, now=None):
+        """Decide whether a reading is anchored and why"""
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._state.get(device_id)
+            reason = self._reason(device_id, state, measurements, now)
+            if reason is None:
+                state['suppressed'] += 1
+                return False, 'suppressed'
+            # Compare later readings with the last anchored values, so slow drifts still cross the band
+            self._state[device_id] = {'values': dict(measurements), 'time': now, 'suppressed': 0}
+            return True, reason
+
+    # Reason to anchor a reading, or None to keep it local
+    def _reason(self, device_id, state, measurements, now):
+        """Reason to anchor a reading, or None to keep it local"""
+        if state is None:
+            return 'first'
+        if now - state['time'] >= self.max_interval:
+            return 'max_interval'
+        if self.heartbeat_every and state['suppressed'] + 1 >= self.heartbeat_every:
+            return 'heartbeat'
+        thresholds = self.thresholds_for(device_id)
+        for channel, value in measurements.items():
+            previous = state['values'].get(channel)
+            if previous is None or value is None:
+                if previous != value:
+                    return f"change:{channel}"
+                continue
+            if abs(value - previous) > thresholds.get(channel, 0):
+                return f"change:{channel}"
+        return None
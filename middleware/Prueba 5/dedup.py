@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+log = logging.getLogger('middleware.dedup')
+
+
+# Deduplication key of a TTN uplink: device, frame counter and payload hash
+def uplink_key(payload):
+    """Deduplication key of a TTN uplink: device, frame counter and payload hash"""
+    device_id = payload['end_device_ids']['device_id']
+    uplink = payload.get('uplink_message', {})
+    content = uplink.get('frm_payload')
+    if content is None:
+        content = json.dumps(uplink.get('decoded_payload'), sort_keys=True)
+    digest = hashlib.sha256(content.encode()).hexdigest()[:16]
+    # The payload hash keeps a frame counter reset after a rejoin from looking like a duplicate
+    return f"{device_id}|{uplink.get('f_cnt', '')}|{digest}"
+
+
+# Bounded cache of recently seen uplinks, expiring and evicting them in first-seen order
+class DedupCache:
+    def __init__(self, max_entries=10000, ttl=3600.0, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self._entries = OrderedDict()  # key -> time first seen, oldest first
+        self._lock = threading.Lock()
+        self._journal_lines = 0
+        if self.path:
+            self._load()
+
+    # Check whether a key was already seen, recording it if not
+    def seen(self, key):
+        """Check whether a key was already seen, recording it if not"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                # Not moved on a hit: the TTL counts from the first sighting, and _expire relies on the order
+                return True
+            self._entries[key] = now
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path:
+                self._append(key, now)
+            return False
+
+    # Drop entries older than the TTL
+    def _expire(self, now):
+        """Drop entries older than the TTL"""
+        while self._entries:
+            key, first_seen = next(iter(self._entries.items()))
+            if now - first_seen < self.ttl:
+                break
+            self._entries.popitem(last=False)
+
+    # Append a key to the persistence journal
+    def _append(self, key, now):
+        """Append a key to the persistence journal"""
+        try:
+            with self.path.open('a') as f:
+                f.write(f"{now:.3f}\t{key}\n")
+            self._journal_lines += 1
+            if self._journal_lines > 2 * self.max_entries:
+                self._compact()
+        except Exception as e:
+            log.error("Error persisting dedup key: %s", e)
+
+    # Rewrite the journal with the live entries only
+    def _compact(self):
+        """Rewrite the journal with the live entries only"""
+        tmp = self.path.with_suffix('.tmp')
+        with tmp.open('w') as f:
+            for key, first_seen in self._entries.items():
+                f.write(f"{first_seen:.3f}\t{key}\n")
+        tmp.replace(self.path)
+        self._journal_lines = len(self._entries)
+
+    # Load unexpired keys saved by a previous run
+    def _load(self):
+        """Load unexpired keys saved by a previous run"""
+        if not self.path.exists():
+            return
+        try:
+            now = time.time()
+            with self.path.open('r') as f:
+                for line in f:
+                    first_seen, _, key = line.rstrip('\n').partition('\t')
+                    if key and now - float(first_seen) < self.ttl:
+                        self._entries[key] = float(first_seen)
+                        self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._compact()
+            log.info("Loaded %d dedup keys", len(self._entries))
+        except Exception as e:
+            log.error("Error loading dedup keys: %s", e)
@@ -0,0 +1,125 @@
+import base64
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+log = logging.getLogger('middleware.inbox')
+
+
+# Uplink as read by the middleware (the parts of a paho message it uses)
+class Uplink:
+    __slots__ = ('topic', 'payload', 'received_at')
+
+    def __init__(self, topic, payload, received_at):
+        self.topic = topic
+        self.payload = payload
+        self.received_at = received_at  # Reception time, so queueing counts in the response time
+
+
+# Journal of received uplinks, written before they are acknowledged to the broker
+class UplinkJournal:
+    def __init__(self, path='inbox.jsonl', fsync=False, compact_bytes=1 << 20):
+        self.path = Path(path)
+        self.fsync = fsync  # Also survive power loss, at the cost of one disk sync per uplink
+        self.compact_bytes = compact_bytes  # Rewrite with only the pending uplinks once the file is this large
+        self._pending = {}  # seq -> Uplink not yet stored, spooled or discarded
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._compacted_size = 0  # Size right after the last rewrite
+        self._load()
+        self._rewrite()
+
+    # Recover uplinks left unfinished by a previous run
+    def _load(self):
+        """Recover uplinks left unfinished by a previous run"""
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open('r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line after a crash
+                    if 'done' in entry:
+                        self._pending.pop(entry['done'], None)
+                    else:
+                        self._pending[entry['seq']] = Uplink(
+                            entry['topic'], base64.b64decode(entry['payload']), entry['received_at'])
+        except Exception as e:
+            log.error("Error loading uplink journal: %s", e)
+        self._seq = max(self._pending, default=0)
+        if self._pending:
+            log.info("Recovered %d unfinished uplinks", len(self._pending))
+
+    # Journal line of an uplink
+    @staticmethod
+    def _line(seq, uplink):
+        """Journal line of an uplink"""
+        return json.dumps({
+            'seq': seq,
+            'topic': uplink.topic,
+            'payload': base64.b64encode(uplink.payload).decode(),
+            'received_at': uplink.received_at
+        }) + '\n'
+
+    # Replace the journal with only the pending uplinks and reopen it for appending
+    def _rewrite(self):
+        """Replace the journal with only the pending uplinks and reopen it for appending"""
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            for seq, uplink in self._pending.items():
+                f.write(self._line(seq, uplink))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self._file:
+            self._file.close()
+        self._file = self.path.open('a')
+        self._compacted_size = self._file.tell()
+
+    # Write a line and make it durable
+    def _write(self, line):
+        """Write a line and make it durable"""
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    # Record a received uplink and return its sequence number
+    def append(self, uplink):
+        """Record a received uplink and return its sequence number"""
+        with self._lock:
+            self._seq += 1
+            self._pending[self._seq] = uplink
+            self._write(self._line(self._seq, uplink))
+            return self._seq
+
+    # Mark an uplink as finished (stored, spooled or discarded)
+    def done(self, seq):
+        """Mark an uplink as finished (stored, spooled or discarded)"""
+        with self._lock:
+            if self._pending.pop(seq, None) is None:
+                return
+            self._write(json.dumps({'done': seq}) + '\n')
+            # Twice the live size at least, so a large backlog is not rewritten on every uplink
+            if self._file.tell() >= max(self.compact_bytes, 2 * self._compacted_size):
+                try:
+                    self._rewrite()
+                except Exception as e:
+                    log.error("Error compacting uplink journal: %s", e)
+
+    # Uplinks recovered from a previous run, with their sequence numbers
+    def unfinished(self):
+        """Uplinks recovered from a previous run, with their sequence numbers"""
+        with self._lock:
+            return list(self._pending.items())
+
+    # Number of uplinks not finished yet
+    def depth(self):
+        """Number of uplinks not finished yet"""
+        return len(self._pending)
@@ -0,0 +1,118 @@
+import json
+import logging
+import queue
+import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+# LogRecord attributes that are not user supplied fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+# Format records as one JSON object per line
+class JsonFormatter(logging.Formatter):
+    # Format a record as a JSON line
+    def format(self, record):
+        """Format a record as a JSON line"""
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Let through at most `burst` repeats of a warning/error per interval
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst=5, interval=60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # (level, template) -> [window start, count]
+
+    # Decide whether a record is logged
+    def filter(self, record):
+        """Decide whether a record is logged"""
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is not None and window[1] > self.burst:
+                record.suppressed = window[1] - self.burst  # Repeats dropped in the last window
+            self._windows[key] = [now, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self.burst
+
+
+# Keep one out of every `rate` info/debug records per device
+class DeviceSampleFilter(logging.Filter):
+    def __init__(self, rate=1):
+        super().__init__()
+        self.rate = max(int(rate), 1)
+        self._counts = {}
+
+    # Decide whether a record is logged
+    def filter(self, record):
+        """Decide whether a record is logged"""
+        if self.rate == 1 or record.levelno >= logging.WARNING:
+            return True
+        device_id = getattr(record, 'device_id', None)
+        if device_id is None:
+            return True
+        count = self._counts.get(device_id, 0)
+        self._counts[device_id] = count + 1
+        return count % self.rate == 0
+
+
+# Queue handler that never blocks the caller
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Defer formatting to the background writer
+    def prepare(self, record):
+        """Defer formatting to the background writer"""
+        return record
+
+    # Drop the record when the queue is full
+    def enqueue(self, record):
+        """Drop the record when the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Route all middleware logging through a bounded queue and a background writer
+def setup_logging(level='INFO', path=None, queue_size=10000, error_burst=5,
+                  error_interval=60.0, device_sample=1):
+    """Route all middleware logging through a bounded queue and a background writer"""
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if path:
+        handlers.append(logging.FileHandler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(RateLimitFilter(error_burst, error_interval))
+    queue_handler.addFilter(DeviceSampleFilter(device_sample))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
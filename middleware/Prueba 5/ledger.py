@@ -0,0 +1,153 @@
+import csv
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger('middleware.ledger')
+
+# Posting states of a reading
+POSTING = 'posting'  # Post in progress (a crash here leaves the outcome unknown)
+FAILED = 'failed'  # Rejected or never sent, safe to post again
+AMBIGUOUS = 'ambiguous'  # Error after submission, the node may have accepted the block
+FOUND = 'found'  # Seen on the node after an ambiguous failure, not yet recorded locally
+POSTED = 'posted'  # Posted and recorded
+
+FIELDS = ['time', 'content_hash', 'state', 'block_id', 'attempts']
+
+
+# Content hash of a serialized reading, identifying it across retries and restarts
+def content_hash(payload):
+    """Content hash of a serialized reading, identifying it across retries and restarts"""
+    return hashlib.sha256(payload).hexdigest()
+
+
+# Whether a posting error means the block surely was not accepted
+def is_definite_failure(error):
+    """Whether a posting error means the block surely was not accepted"""
+    text = str(error).lower()
+    return any(marker in text for marker in (
+        '429', 'too many requests', 'rate limit', 'no healthy node', 'connection refused', 'invalid'))
+
+
+# Append-only journal of the posting state of every reading
+class PostLedger:
+    def __init__(self, path='post_ledger.csv', grace=60.0, retention=7 * 86400):
+        self.path = Path(path)
+        self.grace = grace  # Seconds an ambiguous post is given to show up on the node
+        self.retention = retention  # Seconds posted readings are remembered
+        self._entries = {}  # content hash -> {'time', 'state', 'block_id', 'attempts'}
+        self._lock = threading.Lock()
+        self._load()
+
+    # Replay the journal and rewrite it with the latest state of each reading
+    def _load(self):
+        """Replay the journal and rewrite it with the latest state of each reading"""
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open('r', newline='') as f:
+                for row in csv.DictReader(f):
+                    self._entries[row['content_hash']] = {
+                        'time': float(row['time']),
+                        'state': row['state'],
+                        'block_id': row['block_id'],
+                        'attempts': int(row['attempts'])
+                    }
+        except Exception as e:
+            log.error("Error loading posting ledger: %s", e)
+        self._expire()
+        for entry in self._entries.values():
+            if entry['state'] == POSTING:
+                entry['state'] = AMBIGUOUS  # Interrupted mid-post in a previous run
+        self._rewrite()
+        log.info("Posting ledger loaded with %d readings", len(self._entries))
+
+    # Forget posted readings older than the retention, returning how many were dropped
+    def _expire(self):
+        """Forget posted readings older than the retention, returning how many were dropped"""
+        cutoff = time.time() - self.retention
+        expired = [key for key, entry in self._entries.items() if entry['state'] == POSTED and entry['time'] < cutoff]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    # Replace the journal with the latest state of each reading
+    def _rewrite(self):
+        """Replace the journal with the latest state of each reading"""
+        tmp = self.path.with_suffix('.tmp')
+        with tmp.open('w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            for key, entry in self._entries.items():
+                writer.writerow([entry['time'], key, entry['state'], entry['block_id'], entry['attempts']])
+        tmp.replace(self.path)
+
+    # Drop expired readings and compact the journal, so a long run does not grow it without bound
+    def prune(self):
+        """Drop expired readings and compact the journal"""
+        with self._lock:
+            expired = self._expire()
+            self._rewrite()
+        if expired:
+            log.info("Posting ledger pruned: %d expired, %d kept", expired, len(self._entries))
+
+    # Record a new state for a reading, returning its previous state ('' if new), or None if
+    # `only_from` is given and the reading is not in one of those states
+    def _record(self, key, state, block_id=None, attempt=False, only_from=None):
+        """Record a new state for a reading, returning its previous state"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if only_from is not None and (entry is None or entry['state'] not in only_from):
+                return None
+            previous = entry['state'] if entry else ''
+            entry = self._entries.setdefault(key, {'time': 0.0, 'state': state, 'block_id': '', 'attempts': 0})
+            entry['time'] = time.time()
+            entry['state'] = state
+            entry['block_id'] = block_id or entry['block_id']
+            entry['attempts'] += attempt
+            file_exists = self.path.exists()
+            with self.path.open('a', newline='') as f:
+                writer = csv.writer(f)
+                if not file_exists:
+                    writer.writerow(FIELDS)
+                writer.writerow([entry['time'], key, state, entry['block_id'], entry['attempts']])
+            return previous
+
+    # Current entry of a reading, if any
+    def get(self, key):
+        """Current entry of a reading, if any"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry else None
+
+    # Whether an ambiguous post is still within its grace period
+    def awaiting(self, key):
+        """Whether an ambiguous post is still within its grace period"""
+        entry = self.get(key)
+        return bool(entry) and entry['state'] in (AMBIGUOUS, POSTING) and time.time() - entry['time'] < self.grace
+
+    # Mark a reading as being posted
+    def begin(self, key):
+        """Mark a reading as being posted"""
+        self._record(key, POSTING, attempt=True)
+
+    # Mark a reading as posted and recorded under a block
+    def posted(self, key, block_id):
+        """Mark a reading as posted and recorded under a block"""
+        self._record(key, POSTED, block_id)
+
+    # Mark a failed post as definite or ambiguous
+    def failed(self, key, error=None):
+        """Mark a failed post as definite or ambiguous"""
+        ambiguous = error is not None and not is_definite_failure(error)
+        # Only a post still in progress fails: a block already found on the node (the node event can
+        # arrive before the client times out) or recorded must not go back to a state that reposts it
+        self._record(key, AMBIGUOUS if ambiguous else FAILED, only_from=(POSTING,))
+
+    # Record a block seen on the node for a reading being posted or whose post looked failed,
+    # returning the state it had, or None if there was nothing to record
+    def found(self, key, block_id):
+        """Record a block seen on the node for a reading being posted or whose post looked failed"""
+        return self._record(key, FOUND, block_id, only_from=(POSTING, AMBIGUOUS, FAILED))
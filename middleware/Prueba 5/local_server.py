@@ -0,0 +1,105 @@
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlsplit, parse_qs
+
+log = logging.getLogger('middleware.http')
+
+
+# Small embedded HTTP server for local observability endpoints
+class LocalServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.prefix_routes = {}
+        self.streams = {}
+        self.httpd = None
+
+    # Register a handler returning (status, content type, body)
+    def add_route(self, path, handler):
+        """Register a handler returning (status, content type, body)"""
+        self.routes[path] = handler
+
+    # Register a handler for every path under a prefix, called with the query and the rest of the path
+    def add_prefix_route(self, prefix, handler):
+        """Register a handler for every path under a prefix, called with the query and the rest of the path"""
+        self.prefix_routes[prefix.rstrip('/')] = handler
+
+    # Handler for a path and the arguments it is called with
+    def _resolve(self, path):
+        """Handler for a path and the arguments it is called with"""
+        if path in self.routes:
+            return self.routes[path], ()
+        # Longest matching prefix, so nested APIs can be registered separately
+        for prefix in sorted(self.prefix_routes, key=len, reverse=True):
+            if path == prefix or path.startswith(prefix + '/'):
+                return self.prefix_routes[prefix], (path[len(prefix):].strip('/'),)
+        return None, ()
+
+    # Register a generator of server-sent events
+    def add_stream(self, path, generator):
+        """Register a generator of server-sent events"""
+        self.streams[path] = generator
+
+    # Build the request handler class bound to this server
+    def _handler_class(self):
+        """Build the request handler class bound to this server"""
+        resolve = self._resolve
+        streams = self.streams
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path in streams:
+                    self._stream(streams[url.path])
+                    return
+                handler, args = resolve(url.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    status, content_type, body = handler(query, *args)
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Write each generated event until the client goes away
+            def _stream(self, generator):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    for event in generator():
+                        self.wfile.write(f"data: {event}\n\n".encode())
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            # Keep request logging off stdout
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    # Start serving in a background thread
+    def start(self):
+        """Start serving in a background thread"""
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self.httpd.daemon_threads = True
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        log.info("Local HTTP server listening on http://%s:%s", self.host, self.httpd.server_port)
+
+    # Stop serving
+    def stop(self):
+        """Stop serving"""
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
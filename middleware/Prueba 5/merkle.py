@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+log = logging.getLogger('middleware.merkle')
+
+MERKLE_TAG = 'SENSOR_DATA_MERKLE_ROOT'
+
+
+# Canonical bytes of a reading, so the same reading always hashes the same
+def canonical(reading):
+    """Canonical bytes of a reading"""
+    return json.dumps(reading, sort_keys=True, separators=(',', ':')).encode()
+
+
+# Hash of a leaf (domain separated from inner nodes)
+def leaf_hash(data):
+    """Hash of a leaf"""
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+# Hash of an inner node
+def node_hash(left, right):
+    """Hash of an inner node"""
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+# All levels of the tree, from the leaves up to the root
+def build_levels(leaves):
+    """All levels of the tree, from the leaves up to the root"""
+    if not leaves:
+        raise ValueError("Cannot build a Merkle tree without leaves")
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])  # Odd node is promoted, not duplicated
+        levels.append(parents)
+    return levels
+
+
+# Inclusion proof of a leaf: sibling hashes and their side
+def inclusion_proof(levels, index):
+    """Inclusion proof of a leaf: sibling hashes and their side"""
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(['L' if sibling < index else 'R', level[sibling].hex()])
+        index //= 2
+    return proof
+
+
+# Root obtained by applying a proof to a leaf
+def root_from_proof(leaf, proof):
+    """Root obtained by applying a proof to a leaf"""
+    current = leaf
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        current = node_hash(sibling, current) if side == 'L' else node_hash(current, sibling)
+    return current
+
+
+# Check that a reading is included under a root
+def verify_reading(reading, proof, root_hex):
+    """Check that a reading is included under a root"""
+    return root_from_proof(leaf_hash(canonical(reading)), proof).hex() == root_hex
+
+
+# Stores readings locally and anchors one Merkle root per time window
+class MerkleAnchor:
+    def __init__(self, post_root, on_anchored=None, window=60.0, directory='merkle', encode_series=None):
+        self.post_root = post_root  # (root hex, metadata) -> block id or None
+        self.on_anchored = on_anchored  # (block id, [(reading, ttn time)]) after a root is posted
+        self.encode_series = encode_series  # [reading] -> compressed readings for the metadata, or None
+        self.window = window
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._current = None  # Path of the open window file
+        self._last_stamp = 0  # Millisecond stamp of the last window opened
+
+    # Store a reading in the open window
+    def add(self, reading, ttn_time):
+        """Store a reading in the open window"""
+        line = json.dumps({'ttn_time': ttn_time, 'reading': reading}) + '\n'
+        with self._lock:
+            if self._current is None:
+                self._current = self._new_window()
+            with self._current.open('a') as f:
+                f.write(line)
+
+    # Path of a new window file, named by a strictly increasing millisecond stamp
+    def _new_window(self):
+        """Path of a new window file, named by a strictly increasing millisecond stamp"""
+        # A window opened in the same millisecond as the one just flushed must not append to it
+        stamp = max(int(time.time() * 1000), self._last_stamp + 1)
+        while (self.directory / f"window_{stamp}.jsonl").exists():
+            stamp += 1
+        self._last_stamp = stamp
+        return self.directory / f"window_{stamp}.jsonl"
+
+    # Close the open window and anchor every window without a proofs file
+    def flush(self):
+        """Close the open window and anchor every window without a proofs file"""
+        with self._lock:
+            self._current = None
+            closed = [
+                path for path in sorted(self.directory.glob('window_*.jsonl'))
+                if not path.name.endswith('.proofs.jsonl') and not path.with_suffix('.proofs.jsonl').exists()
+            ]
+        for path in closed:
+            self._anchor(path)
+
+    # Build the tree of a closed window, post its root and write the proofs
+    def _anchor(self, path):
+        """Build the tree of a closed window, post its root and write the proofs"""
+        with path.open('r') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        if not entries:
+            path.unlink()
+            return
+        levels = build_levels([leaf_hash(canonical(e['reading'])) for e in entries])
+        root = levels[-1][0].hex()
+        ttn_times = [e['ttn_time'] for e in entries]
+        metadata = {
+            'version': 1,
+            'root': root,
+            'count': len(entries),
+            'devices': len({e['reading'].get('deviceId') for e in entries}),
+            'windowStart': datetime.fromtimestamp(min(ttn_times)).isoformat(),
+            'windowEnd': datetime.fromtimestamp(max(ttn_times)).isoformat(),
+            'batch': path.stem
+        }
+        if self.encode_series:
+            series = self.encode_series([e['reading'] for e in entries])
+            if series:
+                metadata['series'] = series
+        block_id = self.post_root(root, metadata)
+        if not block_id:
+            return  # Window stays pending and is retried on the next flush
+
+        tmp = path.with_suffix('.proofs.tmp')
+        with tmp.open('w') as f:
+            for index, entry in enumerate(entries):
+                f.write(json.dumps({
+                    'index': index,
+                    'block_id': block_id,
+                    'root': root,
+                    'proof': inclusion_proof(levels, index),
+                    'reading': entry['reading']
+                }) + '\n')
+        tmp.replace(path.with_suffix('.proofs.jsonl'))
+        log.info("Anchored %d readings under Merkle root %s in block %s", len(entries), root, block_id)
+        if self.on_anchored:
+            self.on_anchored(block_id, [(e['reading'], e['ttn_time']) for e in entries])
+
+    # Anchor windows periodically
+    def run(self, stop=None):
+        """Anchor windows periodically until stopped"""
+        stop = stop or threading.Event()
+        while not stop.wait(self.window):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Error anchoring Merkle window: %s", e)
+
+
+# Fetch the Merkle root anchored in a block
+def fetch_anchored_root(node_url, block_id):
+    """Fetch the Merkle root anchored in a block"""
+    import requests
+
+    response = requests.get(f"{node_url}/api/core/v2/blocks/{block_id}", timeout=10)
+    response.raise_for_status()
+    payload = response.json()['payload']
+    if bytes.fromhex(payload['tag'][2:]).decode() != MERKLE_TAG:
+        raise ValueError(f"Block {block_id} is not a Merkle root anchor")
+    return json.loads(bytes.fromhex(payload['data'][2:]).decode())['root']
+
+
+# Verify locally stored readings against the roots anchored on the ledger
+def main():
+    """Verify locally stored readings against the roots anchored on the ledger"""
+    parser = argparse.ArgumentParser(description='Verify readings against their anchored Merkle root')
+    parser.add_argument('proofs', help='window_*.proofs.jsonl file')
+    parser.add_argument('--index', type=int, help='Only verify this reading')
+    parser.add_argument('--node', default=os.environ.get('NODE_URL', 'https://api.testnet.shimmer.network'))
+    args = parser.parse_args()
+
+    roots = {}
+    failures = 0
+    with open(args.proofs) as f:
+        for line in f:
+            entry = json.loads(line)
+            if args.index is not None and entry['index'] != args.index:
+                continue
+            if entry['block_id'] not in roots:
+                roots[entry['block_id']] = fetch_anchored_root(args.node, entry['block_id'])
+            anchored_root = roots[entry['block_id']]
+            ok = anchored_root == entry['root'] and verify_reading(entry['reading'], entry['proof'], anchored_root)
+            failures += not ok
+            print(f"Reading {entry['index']} ({entry['reading'].get('deviceId')}): {'OK' if ok else 'FAILED'}")
+    print(f"{failures} verification failures")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import bisect
+import threading
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Per-thread value cells so hot-path updates never wait on a lock
+class _ThreadCells:
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    # Get the cell owned by the calling thread
+    def get(self):
+        """Get the cell owned by the calling thread"""
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = [0.0] * self._size
+            with self._lock:  # Only taken once per thread
+                self._cells.append(cell)
+            self._local.cell = cell
+        return cell
+
+    # Add up the cells of all threads
+    def total(self):
+        """Add up the cells of all threads"""
+        with self._lock:
+            cells = list(self._cells)
+        totals = [0.0] * self._size
+        for cell in cells:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+# Format a sample value in Prometheus text format
+def _format_value(value):
+    """Format a sample value in Prometheus text format"""
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Format a label set in Prometheus text format
+def _format_labels(names, values, extra=None):
+    """Format a label set in Prometheus text format"""
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+    return '{' + body + '}'
+
+
+# Base class for labelled metrics
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+
+    # Get the child metric for a label set
+    def labels(self, *values):
+        """Get the child metric for a label set"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._children_lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    # Render the metric in Prometheus text format
+    def render(self):
+        """Render the metric in Prometheus text format"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        for suffix, labelvalues, extra, value in self._samples():
+            labels = _format_labels(self.labelnames, labelvalues, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+# Monotonic counter child
+class _CounterChild:
+    def __init__(self):
+        self._cells = _ThreadCells(1)
+
+    # Increment the counter
+    def inc(self, amount=1):
+        """Increment the counter"""
+        self._cells.get()[0] += amount
+
+    # Current value
+    def value(self):
+        """Current value"""
+        return self._cells.total()[0]
+
+
+# Monotonic counter
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    # Increment the unlabelled counter
+    def inc(self, amount=1):
+        """Increment the unlabelled counter"""
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield '', labelvalues, None, child.value()
+
+
+# Gauge child holding a value or a callback evaluated at scrape time
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    # Set the gauge value
+    def set(self, value):
+        """Set the gauge value"""
+        self._value = value
+
+    # Increment the gauge value
+    def inc(self, amount=1):
+        """Increment the gauge value"""
+        with self._lock:
+            self._value += amount
+
+    # Decrement the gauge value
+    def dec(self, amount=1):
+        """Decrement the gauge value"""
+        with self._lock:
+            self._value -= amount
+
+    # Compute the gauge value only when scraped
+    def set_function(self, function):
+        """Compute the gauge value only when scraped"""
+        self._function = function
+
+    # Current value
+    def value(self):
+        """Current value"""
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return float('nan')
+        return self._value
+
+
+# Gauge
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    # Set the unlabelled gauge value
+    def set(self, value):
+        """Set the unlabelled gauge value"""
+        self.labels().set(value)
+
+    # Compute the unlabelled gauge value only when scraped
+    def set_function(self, function):
+        """Compute the unlabelled gauge value only when scraped"""
+        self.labels().set_function(function)
+
+    def _samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield '', labelvalues, None, child.value()
+
+
+# Histogram child with per-thread bucket counts
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # One slot per bucket, one for +Inf, then sum and count
+        self._cells = _ThreadCells(len(buckets) + 3)
+
+    # Record an observation
+    def observe(self, value):
+        """Record an observation"""
+        cell = self._cells.get()
+        cell[bisect.bisect_left(self._buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    # Cumulative bucket counts, sum and count
+    def snapshot(self):
+        """Cumulative bucket counts, sum and count"""
+        totals = self._cells.total()
+        cumulative = []
+        running = 0
+        for count in totals[:-2]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-2], totals[-1]
+
+
+# Histogram
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    # Record an observation on the unlabelled histogram
+    def observe(self, value):
+        """Record an observation on the unlabelled histogram"""
+        self.labels().observe(value)
+
+    def _samples(self):
+        bounds = self.buckets + (float('inf'),)
+        for labelvalues, child in list(self._children.items()):
+            cumulative, total, count = child.snapshot()
+            for bound, value in zip(bounds, cumulative):
+                yield '_bucket', labelvalues, ('le', _format_value(bound)), value
+            yield '_sum', labelvalues, None, total
+            yield '_count', labelvalues, None, count
+
+
+# Collection of metrics rendered together
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    # Register a metric
+    def register(self, metric):
+        """Register a metric"""
+        self._metrics.append(metric)
+        return metric
+
+    # Render all metrics in Prometheus text format
+    def render(self):
+        """Render all metrics in Prometheus text format"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+    # HTTP route handler for /metrics
+    def handle_request(self, query):
+        """HTTP route handler for /metrics"""
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', self.render().encode()
+
+
+# Metrics exposed by the middleware
+class MiddlewareMetrics(MetricsRegistry):
+    def __init__(self):
+        super().__init__()
+        self.uplinks_received = self.register(Counter(
+            'middleware_uplinks_received_total', 'Uplink messages received from TTN'))
+        self.mqtt_disconnects = self.register(Counter(
+            'middleware_mqtt_disconnects_total', 'Unexpected disconnections from the TTN broker'))
+        self.mqtt_reconnect_time = self.register(Histogram(
+            'middleware_mqtt_reconnect_seconds', 'Time from losing the TTN connection to reconnecting',
+            buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)))
+        self.inbox_depth = self.register(Gauge(
+            'middleware_inbox_depth', 'Acknowledged uplinks not yet stored, spooled or discarded'))
+        self.decode_failures = self.register(Counter(
+            'middleware_decode_failures_total', 'Uplink messages that could not be decoded'))
+        self.duplicates_dropped = self.register(Counter(
+            'middleware_duplicate_uplinks_total', 'Duplicate uplinks dropped before posting'))
+        self.readings_filtered = self.register(Counter(
+            'middleware_readings_filtered_total', 'Readings kept locally by the dead-band filter'))
+        self.priority_readings = self.register(Counter(
+            'middleware_priority_readings_total', 'High-priority readings by the channel out of range', ['channel']))
+        self.reposts_avoided = self.register(Counter(
+            'middleware_reposts_avoided_total', 'Retried readings resolved from the posting ledger without a new block'))
+        self.posts = self.register(Counter(
+            'middleware_iota_posts_total', 'Block posts to the IOTA node by result', ['result']))
+        self.post_concurrency_limit = self.register(Gauge(
+            'middleware_post_concurrency_limit', 'Adaptive (AIMD) limit of posts in flight per node', ['node']))
+        self.posts_inflight = self.register(Gauge(
+            'middleware_posts_inflight', 'Block posts currently in flight per node', ['node']))
+        self.rate_limit_wait = self.register(Histogram(
+            'middleware_rate_limit_wait_seconds', 'Time posts waited for a rate limiter token', ['limiter'],
+            buckets=(0.0, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)))
+        self.post_latency = self.register(Histogram(
+            'middleware_iota_post_latency_seconds', 'Time spent in build_and_post_block'))
+        self.confirmation_latency = self.register(Histogram(
+            'middleware_confirmation_latency_seconds', 'Time from TTN reception to Tangle confirmation',
+            buckets=(0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)))
+        self.inflight_blocks = self.register(Gauge(
+            'middleware_inflight_blocks', 'Posted blocks waiting for confirmation'))
+        self.spool_depth = self.register(Gauge(
+            'middleware_pending_spool_depth', 'Messages stored in the pending spool'))
+        self.node_up = self.register(Gauge(
+            'middleware_node_up', 'IOTA node health state (1 healthy, 0 unreachable)', ['node']))
+        self.encryption_time = self.register(Histogram(
+            'middleware_encryption_seconds', 'Time spent encrypting a reading',
+            buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)))
@@ -1,27 +1,120 @@
+import time
+_startup_start = time.perf_counter()  # Reference point for the startup time breakdown
 import os
 import json
-import time
 from datetime import datetime
-import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-from iota_sdk import Client, utf8_to_hex
 import ssl
 import csv
 import requests
-from threading import Thread
+from threading import Thread, RLock, BoundedSemaphore, Event
+from concurrent.futures import ThreadPoolExecutor, wait
 import queue
-import matplotlib.pyplot as plt
-import pandas as pd
-from matplotlib.dates import DateFormatter, SecondLocator
-from cryptography.fernet import Fernet
+import itertools
 import base64
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import logging
 from pathlib import Path
+from metrics import MiddlewareMetrics
+from local_server import LocalServer
+from tracing import Tracer, FileSpanExporter, OTLPHttpExporter, NOOP_TRACE, NOOP_SPAN
+from json_logging import setup_logging
+from dashboard import RollingStats, Dashboard
+from dedup import DedupCache, uplink_key
+from deadband import DeadbandFilter
+from merkle import MerkleAnchor, MERKLE_TAG
+from posting import NodePool, TokenBucket, is_throttled
+from block_builder import BlockBuildPool
+from ledger import PostLedger, content_hash, AMBIGUOUS, FAILED, FOUND, POSTED
+from reading import SensorReading
+from priority import PriorityClassifier, HIGH, NORMAL
+from cluster import HashRing, topic_device
+from inbox import Uplink, UplinkJournal
+from confirmations import ConfirmationJournal
+from rollups import Rollups
+from archive import ParquetArchive
+from mqtt_session import ReconnectBackoff, persistent_client, run_forever
 
 # Load environment variables
 load_dotenv(dotenv_path='../.env')
 
+log = logging.getLogger('middleware')
+
+# Convert a UTF-8 string to a hex string (same as iota_sdk.utf8_to_hex, without importing the SDK)
+def utf8_to_hex(utf8_data):
+    """Convert a UTF-8 string to a hex string"""
+    return '0x' + utf8_data.encode('utf-8').hex()
+
+# Tag of the blocks carrying encrypted readings
+DATA_TAG = utf8_to_hex('ENCRYPTED_SENSOR_DATA')
+
+# Confirmations of the blocks in iota_data.csv, appended as they arrive
+CONFIRMATIONS_FILE = 'iota_confirmations.csv'
+
+
+# Transactions of iota_data.csv with the confirmations of iota_confirmations.csv merged in
+def load_transactions(pd, data_file='iota_data.csv', confirmations_file=CONFIRMATIONS_FILE):
+    """Transactions of iota_data.csv with the confirmations of iota_confirmations.csv merged in"""
+    df = pd.read_csv(data_file, dtype={'Block ID': str, 'TTN time': str, 'Confirmation time': str})
+    df['TTN time'] = pd.to_datetime(df['TTN time'], format='ISO8601', errors='coerce')
+    df['Confirmation time'] = pd.to_datetime(df['Confirmation time'], format='ISO8601', errors='coerce')
+    df['Response time'] = pd.to_numeric(df['Response time'], errors='coerce')
+    df['Confirmed'] = df['Confirmed'].astype(str).str.lower().eq('true')
+    if not os.path.exists(confirmations_file):
+        return df
+    confirmations = pd.read_csv(confirmations_file, dtype={'Block ID': str}).drop_duplicates('Block ID', keep='last')
+    confirmed = df['Block ID'].map(confirmations.set_index('Block ID')['Confirmation time'])
+    confirmed = pd.to_datetime(confirmed, format='ISO8601', errors='coerce')
+    # Rows anchored together (Merkle batches) each get their own response time, from their TTN time
+    df['Response time'] = (confirmed - df['TTN time']).dt.total_seconds().round(2).fillna(df['Response time'])
+    df['Confirmation time'] = confirmed.combine_first(df['Confirmation time'])
+    df['Confirmed'] |= confirmed.notna()
+    return df
+
+
+# TTN uplink topic subscribed by this process
+def uplink_topic():
+    """TTN uplink topic subscribed by this process"""
+    topic = f"v3/{Config.TTN_APP_ID}@ttn/devices/+/up"
+    if Config.CLUSTER_MODE == 'shared':
+        topic = f"$share/{Config.CLUSTER_GROUP}/{topic}" # The broker splits uplinks between the group
+    return topic
+
+# Record how long each startup phase takes
+class StartupTimer:
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = {}
+        self.reported = False
+
+    # Close the current foreground phase
+    def mark(self, phase):
+        """Close the current foreground phase"""
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    # Run a background initialization step and record its duration
+    def timed(self, phase, function):
+        """Run a background initialization step and record its duration"""
+        start = time.perf_counter()
+        try:
+            return function()
+        finally:
+            self.phases[f"{phase} (background)"] = time.perf_counter() - start
+
+    # Log the startup time breakdown once
+    def report(self):
+        """Log the startup time breakdown once"""
+        if self.reported:
+            return
+        self.reported = True
+        total = time.perf_counter() - self.start
+        phases_ms = {phase: round(duration * 1000, 1) for phase, duration in self.phases.items()}
+        log.info("Startup time breakdown (total %.0f ms): %s", total * 1000,
+                 ', '.join(f"{phase}={ms} ms" for phase, ms in phases_ms.items()),
+                 extra={'startup_total_ms': round(total * 1000, 1), 'startup_phases_ms': phases_ms})
+
 # Configuration settings for the middleware
 class Config:
     TTN_BROKER = "eu1.cloud.thethings.network"
@@ -29,25 +122,227 @@ class Config:
     TTN_APP_ID = os.getenv('TTN_APP_ID')
     TTN_API_KEY = os.getenv('TTN_API_KEY')
     NODE_URL = os.environ.get('NODE_URL', 'https://api.testnet.shimmer.network')
+    NODE_URLS = [url.strip() for url in os.environ.get('NODE_URLS', NODE_URL).split(',') if url.strip()]
     EXPLORER_URL = os.environ.get('EXPLORER_URL', 'https://explorer.shimmer.network/testnet')
     VERIFICATION_INTERVAL = 0.1  # 100ms
     MAX_RETRY_ATTEMPTS = 300  # 30 seconds total
+    POST_INITIAL_CONCURRENCY = int(os.environ.get('POST_INITIAL_CONCURRENCY', '2'))  # Posts in flight per node at start
+    POST_MAX_CONCURRENCY = int(os.environ.get('POST_MAX_CONCURRENCY', '16'))  # Upper bound per node
+    POST_LATENCY_TARGET = float(os.environ.get('POST_LATENCY_TARGET', '2.0'))  # Slower posts shrink the limit
+    POST_QUEUE_LIMIT = int(os.environ.get('POST_QUEUE_LIMIT', '1000'))  # Readings waiting before MQTT intake blocks
+    NODE_RATE_LIMIT = float(os.environ.get('NODE_RATE_LIMIT', '0'))  # Posts per second per node (0 disables)
+    NODE_RATE_BURST = int(os.environ.get('NODE_RATE_BURST', '10'))  # Posts allowed at once above the rate
+    APP_RATE_LIMIT = float(os.environ.get('APP_RATE_LIMIT', '0'))  # Posts per second for this TTN application (0 disables)
+    APP_RATE_BURST = int(os.environ.get('APP_RATE_BURST', '20'))
+    CONFIRMATION_WORKERS = int(os.environ.get('CONFIRMATION_WORKERS', '4'))
+    # Processes building blocks with local proof of work per middleware process
+    # ('auto' shares the cores among the WORKER_PROCESSES workers, 0 leaves it to the node)
+    POW_PROCESSES = os.environ.get('POW_PROCESSES', '0')
+    POW_PROCESSES = (
+        max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get('WORKER_PROCESSES', '1'))))
+        if POW_PROCESSES == 'auto' else int(POW_PROCESSES)
+    )
+    HTTP_HOST = os.environ.get('HTTP_HOST', '127.0.0.1')
+    HTTP_PORT = int(os.environ.get('HTTP_PORT', '9108'))  # 0 disables the local HTTP server
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.1'))  # Fraction of messages traced
+    TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+    OTLP_ENDPOINT = os.environ.get('OTLP_ENDPOINT')  # e.g. http://localhost:4318, overrides TRACE_FILE
+    DASHBOARD_WINDOW = int(os.environ.get('DASHBOARD_WINDOW', '300'))  # Rolling window in seconds
+    RECENT_READINGS = int(os.environ.get('RECENT_READINGS', '1024'))  # Readings kept in memory per device (0 disables)
+    ROLLUPS_DIR = os.environ.get('ROLLUPS_DIR', 'rollups')  # Minute and hour aggregates per device and channel ('' disables)
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '')  # Partitioned Parquet archive, needs pyarrow ('' disables)
+    ARCHIVE_FLUSH_ROWS = int(os.environ.get('ARCHIVE_FLUSH_ROWS', '10000'))  # Rows per partition before writing a file
+    ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('ARCHIVE_FLUSH_INTERVAL', '300'))  # Seconds between checks of smaller partitions
+    ARCHIVE_MIN_ROWS = int(os.environ.get('ARCHIVE_MIN_ROWS', '1000'))  # Rows a partition needs before a check writes it
+    ARCHIVE_MAX_AGE = float(os.environ.get('ARCHIVE_MAX_AGE', str(6 * 3600)))  # Seconds a smaller partition may stay buffered
+    DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', '10000'))
+    DEDUP_TTL = float(os.environ.get('DEDUP_TTL', '3600'))  # Seconds a seen uplink is remembered
+    DEDUP_FILE = os.environ.get('DEDUP_FILE')  # Optional file to remember uplinks across restarts
+    # Dead-band per channel, e.g. {"default": {"aht10_temperature": 0.2}, "<device_id>": {...}}; empty disables
+    DEADBAND = json.loads(os.environ.get('DEADBAND', '{}'))
+    DEADBAND_HEARTBEAT_EVERY = int(os.environ.get('DEADBAND_HEARTBEAT_EVERY', '0'))  # Anchor 1 of every N readings
+    DEADBAND_MAX_INTERVAL = float(os.environ.get('DEADBAND_MAX_INTERVAL', '3600'))  # Max seconds between anchors
+    ANCHOR_MODE = os.environ.get('ANCHOR_MODE', 'block')  # 'block' posts every reading, 'merkle' posts one root per window
+    MERKLE_WINDOW = float(os.environ.get('MERKLE_WINDOW', '60'))  # Seconds per anchored batch
+    MERKLE_DIR = os.environ.get('MERKLE_DIR', 'merkle')  # Local storage of readings and inclusion proofs
+    MERKLE_SERIES = os.environ.get('MERKLE_SERIES', 'false').lower() == 'true'  # Post the window's readings compressed
+    MERKLE_SERIES_MAX_BYTES = int(os.environ.get('MERKLE_SERIES_MAX_BYTES', '24000'))  # Keep blocks under the size limit
+    # Allowed range per channel, e.g. {"default": {"soil_moisture": {"min": 20}}, "<device_id>": {...}}; empty disables
+    PRIORITY_RULES = json.loads(os.environ.get('PRIORITY_RULES', '{}'))
+    PRIORITY_CONCURRENCY = int(os.environ.get('PRIORITY_CONCURRENCY', '4'))  # Posts in flight for high-priority readings
+    LEDGER_FILE = os.environ.get('LEDGER_FILE', 'post_ledger.csv')  # Posting state per reading content hash
+    LEDGER_GRACE = float(os.environ.get('LEDGER_GRACE', '60'))  # Seconds an ambiguous post may take to show up
+    LEDGER_RETENTION = float(os.environ.get('LEDGER_RETENTION', str(7 * 86400)))  # Seconds posted readings are remembered
+    LEDGER_PRUNE_INTERVAL = float(os.environ.get('LEDGER_PRUNE_INTERVAL', '3600'))  # Seconds between ledger compactions
+    ENCRYPTION_SALT_FILE = os.environ.get('ENCRYPTION_SALT_FILE', 'encryption_salt.bin')  # Key salt kept across restarts
+    # Cluster mode: '' single process, 'shared' MQTT shared subscription, 'hash' consistent hashing on device id
+    CLUSTER_MODE = os.environ.get('CLUSTER_MODE', '')
+    CLUSTER_GROUP = os.environ.get('CLUSTER_GROUP', 'middleware')  # Shared subscription group
+    SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+    SHARD_ID = int(os.environ.get('SHARD_ID', '0'))  # 0 .. SHARD_COUNT - 1
+    DATA_DIR = os.environ.get('DATA_DIR', f"shard-{SHARD_ID}" if CLUSTER_MODE else '.')  # Spool, ledger and results
+    # Stable client id, so the broker keeps the session (subscription and queued QoS 1 uplinks) across reconnects
+    MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', f"python-bridge-{TTN_APP_ID}-{SHARD_ID}")
+    MQTT_RECONNECT_MIN = float(os.environ.get('MQTT_RECONNECT_MIN', '0.5'))  # Seconds, first reconnect backoff
+    MQTT_RECONNECT_MAX = float(os.environ.get('MQTT_RECONNECT_MAX', '60'))  # Seconds, backoff ceiling
+    INBOX_FILE = os.environ.get('INBOX_FILE', 'inbox.jsonl')  # Uplinks received but not yet stored or spooled
+    INBOX_FSYNC = os.environ.get('INBOX_FSYNC', 'false').lower() == 'true'  # Sync to disk before acknowledging
+    WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '1'))  # >1 fans uplinks out to worker processes
+    PLOT_ON_SHUTDOWN = os.environ.get('PLOT_ON_SHUTDOWN', 'false').lower() == 'true'
+    SHUTDOWN_DEADLINE = float(os.environ.get('SHUTDOWN_DEADLINE', '30'))  # Seconds to drain posts and confirmations
+    # Posted blocks not yet confirmed, replayed on the next start after a crash or shutdown
+    CONFIRMATION_JOURNAL = os.environ.get('CONFIRMATION_JOURNAL', 'confirmation_journal.csv')
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_FILE = os.environ.get('LOG_FILE')  # Optional JSON lines file in addition to stdout
+    LOG_ERROR_BURST = int(os.environ.get('LOG_ERROR_BURST', '5'))  # Repeats of one error per interval
+    LOG_ERROR_INTERVAL = float(os.environ.get('LOG_ERROR_INTERVAL', '60'))
+    LOG_DEVICE_SAMPLE = int(os.environ.get('LOG_DEVICE_SAMPLE', '1'))  # Log 1 of every N messages per device
 
 # Middleware class for handling TTN to IOTA communication
 class Middleware:
     # Initialize middleware
     def __init__(self):
-        self.iota_client = Client(nodes=[Config.NODE_URL])
-        self.confirmation_queue = queue.Queue()
+        self.startup = StartupTimer(_startup_start)
+        self.startup.mark('imports and configuration')
+        self.block_builder = None  # Process pool for local PoW, set up with the node pool
+        # IOTA client and key derivation are initialized in parallel while the rest starts up
+        self._init_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='init')
+        self._node_pool_future = self._init_pool.submit(
+            self.startup.timed, 'iota clients', self._setup_node_pool)
+        self._cipher_suite_future = self._init_pool.submit(
+            self.startup.timed, 'encryption key', self._setup_encryption)
+        self.confirmation_queue = queue.PriorityQueue()  # (priority, sequence, confirmation details)
+        self._confirmation_sequence = itertools.count()  # Keeps FIFO order within a priority
         self.pending_data_file = Path('pending_data.csv')
         self.connection_status = True
-        self.cipher_suite = self._setup_encryption()
+        self.storage_lock = RLock()  # CSV files are written from several posting/confirmation threads
+        self.post_executor = ThreadPoolExecutor(
+            max_workers=Config.POST_MAX_CONCURRENCY * len(Config.NODE_URLS), thread_name_prefix='post')
+        self._post_slots = BoundedSemaphore(Config.POST_QUEUE_LIMIT)
+        self._posts_in_flight = set()  # Posting futures not finished yet, drained on shutdown
+        self.stopping = Event()  # Set on shutdown: monitors stop and intake is drained
+        self.confirmations_cutoff = Event()  # Set at the shutdown deadline: pending confirmations are persisted
+        # High-priority readings get their own threads, so a backlog never delays them
+        self.priority_executor = ThreadPoolExecutor(
+            max_workers=Config.PRIORITY_CONCURRENCY, thread_name_prefix='priority')
+        self.priority = PriorityClassifier(Config.PRIORITY_RULES) if Config.PRIORITY_RULES else None
+        self.ring = HashRing(Config.SHARD_COUNT) if Config.CLUSTER_MODE == 'hash' else None
+        self.inbox = UplinkJournal(Config.INBOX_FILE, Config.INBOX_FSYNC)
+        self.confirmations = ConfirmationJournal(Config.CONFIRMATION_JOURNAL)
+        self.mqtt_backoff = ReconnectBackoff(Config.MQTT_RECONNECT_MIN, Config.MQTT_RECONNECT_MAX)
+        self._disconnected_at = None  # When the MQTT connection dropped, to time the reconnect
+        self.metrics = self._setup_metrics()
+        self.tracer = self._setup_tracing()
+        self.live_stats = RollingStats(window_seconds=Config.DASHBOARD_WINDOW)
+        self.recent = self._setup_recent_readings()
+        self.rollups = Rollups(Config.ROLLUPS_DIR) if Config.ROLLUPS_DIR else None
+        self.archive = ParquetArchive(
+            Config.ARCHIVE_DIR, Config.ARCHIVE_FLUSH_ROWS, Config.ARCHIVE_FLUSH_INTERVAL,
+            Config.ARCHIVE_MIN_ROWS, Config.ARCHIVE_MAX_AGE
+        ) if Config.ARCHIVE_DIR else None
+        self.dedup = DedupCache(Config.DEDUP_MAX_ENTRIES, Config.DEDUP_TTL, Config.DEDUP_FILE)
+        self.deadband = DeadbandFilter(
+            Config.DEADBAND, Config.DEADBAND_HEARTBEAT_EVERY, Config.DEADBAND_MAX_INTERVAL
+        ) if Config.DEADBAND else None
+        self.merkle = MerkleAnchor(
+            self.post_merkle_root, self.on_merkle_anchored, Config.MERKLE_WINDOW, Config.MERKLE_DIR,
+            self.encode_merkle_series if Config.MERKLE_SERIES else None
+        ) if Config.ANCHOR_MODE == 'merkle' else None
+        self.block_watcher = None  # IOTA client listening for our blocks on the node
+        self._merkle_nodes = {}  # Merkle root block -> node it was posted to, until it is queued for confirmation
+        self.ledger = PostLedger(Config.LEDGER_FILE, Config.LEDGER_GRACE, Config.LEDGER_RETENTION)
+        self.http_server = None
+        self.startup.mark('middleware state')
+
+    # IOTA nodes used for posting, available once background initialization finishes
+    @property
+    def node_pool(self):
+        """IOTA nodes used for posting, available once background initialization finishes"""
+        return self._node_pool_future.result()
+
+    # IOTA client of the primary node
+    @property
+    def iota_client(self):
+        """IOTA client of the primary node"""
+        return self.node_pool.primary
+
+    # Fernet cipher, available once background key derivation finishes
+    @property
+    def cipher_suite(self):
+        """Fernet cipher, available once background key derivation finishes"""
+        return self._cipher_suite_future.result()
+
+    # Initialize one IOTA client and concurrency limit per node
+    def _setup_node_pool(self):
+        """Initialize one IOTA client and concurrency limit per node"""
+        if Config.POW_PROCESSES:
+            # Block building and PoW run in worker processes; posting threads only wait for them
+            self.block_builder = BlockBuildPool(Config.POW_PROCESSES)
+            clients = {url: self.block_builder.client_for(url) for url in Config.NODE_URLS}
+            log.info("Building blocks with local PoW in %d processes", self.block_builder.processes)
+        else:
+            from iota_sdk import Client
+            clients = {url: Client(nodes=[url]) for url in Config.NODE_URLS}
+        return NodePool(
+            clients,
+            initial=Config.POST_INITIAL_CONCURRENCY,
+            maximum=Config.POST_MAX_CONCURRENCY,
+            latency_target=Config.POST_LATENCY_TARGET,
+            node_rate=Config.NODE_RATE_LIMIT,
+            node_burst=Config.NODE_RATE_BURST,
+            app_bucket=TokenBucket(Config.APP_RATE_LIMIT, Config.APP_RATE_BURST) if Config.APP_RATE_LIMIT else None,
+            on_rate_wait=lambda limiter, waited: self.metrics.rate_limit_wait.labels(limiter).observe(waited)
+        )
+
+    # Initialize metrics exposed on /metrics
+    def _setup_metrics(self):
+        """Initialize metrics exposed on /metrics"""
+        metrics = MiddlewareMetrics()
+        metrics.inflight_blocks.set_function(lambda: self.confirmation_queue.unfinished_tasks)
+        metrics.spool_depth.set_function(self.count_pending_messages)
+        metrics.inbox_depth.set_function(lambda: self.inbox.depth())
+        metrics.node_up.labels(Config.NODE_URL).set(1)
+        for url in Config.NODE_URLS:
+            metrics.post_concurrency_limit.labels(url).set_function(
+                lambda url=url: self.node_pool.limits[url].limit)
+            metrics.posts_inflight.labels(url).set_function(
+                lambda url=url: self.node_pool.limits[url].inflight)
+        return metrics
     
+    # Initialize per-message tracing
+    def _setup_tracing(self):
+        """Initialize per-message tracing"""
+        if Config.OTLP_ENDPOINT:
+            exporter = OTLPHttpExporter(Config.OTLP_ENDPOINT)
+        else:
+            exporter = FileSpanExporter(Config.TRACE_FILE)
+        return Tracer(exporter, sample_rate=Config.TRACE_SAMPLE_RATE)
+
+    # Initialize the in-memory ring buffers of recent readings
+    def _setup_recent_readings(self):
+        """Initialize the in-memory ring buffers of recent readings"""
+        if not Config.RECENT_READINGS:
+            return None
+        from recent import RecentReadings  # NumPy is only loaded when the buffers are enabled
+        return RecentReadings(Config.RECENT_READINGS)
+
     # Initialize encryption key
     def _setup_encryption(self):
         """Initialize encryption key"""
+        from cryptography.fernet import Fernet
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
         password = os.getenv('ENCRYPTION_KEY', 'default_password').encode()
-        salt = os.urandom(16)
+        # The salt is kept, so blocks posted before a restart still decrypt and ambiguous posts can be matched
+        salt_file = Path(Config.ENCRYPTION_SALT_FILE)
+        if salt_file.exists():
+            salt = salt_file.read_bytes()
+        else:
+            salt = os.urandom(16)
+            tmp = salt_file.with_name(salt_file.name + '.tmp')
+            tmp.write_bytes(salt)
+            os.replace(tmp, salt_file)
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
@@ -59,14 +354,14 @@ class Middleware:
 
     # Encrypt data
     def encrypt_data(self, data):
-        """Encrypt data and store metrics"""
+        """Encrypt serialized reading bytes and store metrics"""
         try:
-            json_str = json.dumps(data) # Convert data to JSON string
-            original_size = len(json_str.encode()) # Original data size
+            original_size = len(data) # Original data size
             
             start_time = time.time()
-            encrypted_data = self.cipher_suite.encrypt(json_str.encode()) # Encrypt data
+            encrypted_data = self.cipher_suite.encrypt(data) # Encrypt data
             encryption_time = time.time() - start_time
+            self.metrics.encryption_time.observe(encryption_time)
             
             encrypted_size = len(encrypted_data) # Encrypted data size
             
@@ -82,7 +377,7 @@ class Middleware:
             
             return encrypted_data
         except Exception as e:
-            print(f"Error encrypting data: {str(e)}")
+            log.error("Error encrypting data: %s", e)
             return None
 
     # Decrypt data
@@ -109,7 +404,7 @@ class Middleware:
             
             return json.loads(decrypted_data.decode())
         except Exception as e:
-            print(f"Error decrypting data: {str(e)}")
+            log.error("Error decrypting data: %s", e)
             return None
 
     # Store encryption metrics
@@ -117,103 +412,127 @@ class Middleware:
                                 encryption_time, transmission_time, total_time):
         """Store encryption performance metrics"""
         try:
-            file_exists = os.path.isfile('encryption_metrics.csv')
-            with open('encryption_metrics.csv', mode='a', newline='') as file:
-                writer = csv.writer(file)
-                if not file_exists:
+            with self.storage_lock:
+                file_exists = os.path.isfile('encryption_metrics.csv')
+                with open('encryption_metrics.csv', mode='a', newline='') as file:
+                    writer = csv.writer(file)
+                    if not file_exists:
+                        writer.writerow([
+                            'Timestamp', 'Operation', 'Original size (bytes)',
+                            'Encrypted size (bytes)', 'Encryption time (s)',
+                            'Transmission time (s)', 'Total time (s)'
+                        ])
                     writer.writerow([
-                        'Timestamp', 'Operation', 'Original size (bytes)',
-                        'Encrypted size (bytes)', 'Encryption time (s)',
-                        'Transmission time (s)', 'Total time (s)'
+                        datetime.now().isoformat(), operation_type, original_size,
+                        encrypted_size, f"{encryption_time:.6f}",
+                        f"{transmission_time:.6f}", f"{total_time:.6f}"
                     ])
-                writer.writerow([
-                    datetime.now().isoformat(), operation_type, original_size,
-                    encrypted_size, f"{encryption_time:.6f}",
-                    f"{transmission_time:.6f}", f"{total_time:.6f}"
-                ])
+            if self.archive:
+                self.archive.add_metric(operation_type, original_size, encrypted_size,
+                                        encryption_time, transmission_time, total_time)
         except Exception as e:
-            print(f"Error storing encryption metrics: {str(e)}")
+            log.error("Error storing encryption metrics: %s", e)
 
     # Store sensor data and confirmation details
     def store_data(self, block_id, sensor_data, ttn_time=None, confirmation_time=None):
         """Store sensor data and confirmation details"""
         try:
-            file_exists = os.path.isfile('iota_data.csv')
+            with self.storage_lock:
+                file_exists = os.path.isfile('iota_data.csv')
             
-            if not confirmation_time:
-                with open('iota_data.csv', mode='a', newline='') as file:
+                if not confirmation_time:
+                    with open('iota_data.csv', mode='a', newline='') as file:
+                        writer = csv.writer(file)
+                        if not file_exists:
+                            writer.writerow([
+                                'Block ID', 'Device ID', 'Timestamp', 'AHT10 Temperature', 
+                                'AHT10 Humidity', 'DS18B20 Temperature', 'Light level',
+                                'Soil moisture', 'TTN time', 'Confirmation time',
+                                'Response time', 'Explorer URL', 'Confirmed'
+                            ])
+                    
+                        writer.writerow([
+                            block_id, sensor_data.device_id, datetime.now().isoformat(),
+                            *sensor_data.values,
+                            datetime.fromtimestamp(ttn_time).isoformat() if ttn_time else None,
+                            None, None,
+                            f"{Config.EXPLORER_URL}/block/{block_id}",
+                            False
+                        ])
+                    if self.archive:
+                        self.archive.add_reading(block_id, sensor_data, ttn_time)
+                else:
+                    # Appended rather than rewriting iota_data.csv; reports merge both files by block ID
+                    file_exists = os.path.isfile(CONFIRMATIONS_FILE)
+                    response_time = confirmation_time - ttn_time
+                    with open(CONFIRMATIONS_FILE, mode='a', newline='') as file:
+                        writer = csv.writer(file)
+                        if not file_exists:
+                            writer.writerow(['Block ID', 'Confirmation time', 'Response time'])
+                        writer.writerow([
+                            block_id, datetime.fromtimestamp(confirmation_time).isoformat(), round(response_time, 2)
+                        ])
+                    log.info("Response time: %.2f seconds", response_time, extra={'block_id': block_id})
+                
+        except Exception as e:
+            log.error("Error storing data: %s", e)
+
+    # Store readings kept locally by the dead-band filter
+    def store_filtered_data(self, sensor_data, ttn_time):
+        """Store readings kept locally by the dead-band filter"""
+        try:
+            with self.storage_lock:
+                file_exists = os.path.isfile('filtered_data.csv')
+                with open('filtered_data.csv', mode='a', newline='') as file:
                     writer = csv.writer(file)
                     if not file_exists:
                         writer.writerow([
-                            'Block ID', 'Device ID', 'Timestamp', 'AHT10 Temperature', 
-                            'AHT10 Humidity', 'DS18B20 Temperature', 'Light level',
-                            'Soil moisture', 'TTN time', 'Confirmation time',
-                            'Response time', 'Explorer URL', 'Confirmed'
+                            'Device ID', 'Timestamp', 'AHT10 Temperature', 'AHT10 Humidity',
+                            'DS18B20 Temperature', 'Light level', 'Soil moisture', 'TTN time'
                         ])
-                    
                     writer.writerow([
-                        block_id, sensor_data["deviceId"], datetime.now().isoformat(),
-                        sensor_data["measurements"]["aht10_temperature"],
-                        sensor_data["measurements"]["aht10_humidity"],
-                        sensor_data["measurements"]["ds18b20_temperature"],
-                        sensor_data["measurements"]["light_level"],
-                        sensor_data["measurements"]["soil_moisture"],
-                        datetime.fromtimestamp(ttn_time).isoformat() if ttn_time else None,
-                        None, None,
-                        f"{Config.EXPLORER_URL}/block/{block_id}",
-                        False
+                        sensor_data.device_id, sensor_data.isoformat(),
+                        *sensor_data.values,
+                        datetime.fromtimestamp(ttn_time).isoformat()
                     ])
-            else:
-                # Read data from CSV file
-                df = pd.read_csv('iota_data.csv', dtype={
-                    'Block ID': str,
-                    'Device ID': str,
-                    'Timestamp': str,
-                    'AHT10 Temperature': float,
-                    'AHT10 Humidity': float,
-                    'DS18B20 Temperature': float,
-                    'Light level': float,
-                    'Soil moisture': float,
-                    'TTN time': str,
-                    'Confirmation time': str,
-                    'Response time': str,
-                    'Explorer URL': str,
-                    'Confirmed': bool
-                })
-                
-                mask = df['Block ID'] == block_id
-                response_time = confirmation_time - ttn_time
-                
-                # Update confirmation details
-                df.loc[mask, 'Confirmation time'] = datetime.fromtimestamp(confirmation_time).isoformat()
-                df.loc[mask, 'Response time'] = str(round(response_time, 2))
-                df.loc[mask, 'Confirmed'] = True
-                
-                df.to_csv('iota_data.csv', index=False)
-                print(f"\nResponse time: {response_time:.2f} seconds")
-                
+            if self.archive:
+                self.archive.add_reading(None, sensor_data, ttn_time)
         except Exception as e:
-            print(f"Error storing data: {str(e)}")
+            log.error("Error storing filtered data: %s", e)
 
     # Save pending message when offline
-    def save_pending_message(self, device_id, sensor_data):
+    def save_pending_message(self, device_id, sensor_data, payload=None):
         """Save message to pending queue when offline"""
         try:
-            file_exists = self.pending_data_file.exists() # Check if file exists
+            text = (payload or sensor_data.to_bytes()).decode() # The bytes already serialized for posting
+            with self.storage_lock:
+                file_exists = self.pending_data_file.exists() # Check if file exists
             
-            with self.pending_data_file.open('a', newline='') as f:
-                writer = csv.writer(f)
-                if not file_exists:
-                    writer.writerow(['device_id', 'timestamp', 'sensor_data'])
+                with self.pending_data_file.open('a', newline='') as f:
+                    writer = csv.writer(f)
+                    if not file_exists:
+                        writer.writerow(['device_id', 'timestamp', 'sensor_data'])
                 
-                writer.writerow([
-                    device_id,
-                    datetime.now().isoformat(),
-                    json.dumps(sensor_data)
-                ])
-            print(f"Message saved for device {device_id}")
+                    writer.writerow([
+                        device_id,
+                        datetime.now().isoformat(),
+                        text
+                    ])
+                log.info("Message saved for device %s", device_id, extra={'device_id': device_id})
         except Exception as e:
-            print(f"Error saving pending message: {str(e)}")
+            log.error("Error saving pending message: %s", e)
+
+    # Replace the pending spool with the given messages
+    def _rewrite_pending(self, messages):
+        """Replace the pending spool with the given messages"""
+        with self.storage_lock:
+            if not messages:
+                self.pending_data_file.unlink(missing_ok=True)
+                return
+            with self.pending_data_file.open('w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['device_id', 'timestamp', 'sensor_data'])
+                writer.writeheader()
+                writer.writerows(messages)
 
     # Load pending messages when back online
     def load_pending_messages(self):
@@ -224,12 +543,20 @@ class Middleware:
                 with self.pending_data_file.open('r', newline='') as f:
                     reader = csv.DictReader(f)
                     messages = list(reader)
-                print(f"Loaded {len(messages)} pending messages")
+                log.debug("Loaded %d pending messages", len(messages))
             return messages
         except Exception as e:
-            print(f"Error loading pending messages: {str(e)}")
+            log.error("Error loading pending messages: %s", e)
             return []
 
+    # Count messages in the pending spool
+    def count_pending_messages(self):
+        """Count messages in the pending spool"""
+        if not self.pending_data_file.exists():
+            return 0
+        with self.pending_data_file.open('r', newline='') as f:
+            return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+
     # Check network connection
     def check_connection(self):
         """Check if IOTA node is reachable"""
@@ -239,41 +566,57 @@ class Middleware:
         except Exception:
             return False
 
-    # Send encrypted data to IOTA
-    def send_to_iota(self, sensor_data, ttn_time, device_id):
-        """Send encrypted data to IOTA"""
+    # Send encrypted data to IOTA, returning the block ID and the node it was posted to
+    def send_to_iota(self, sensor_data, ttn_time, device_id, trace=NOOP_TRACE, payload=None, priority=NORMAL):
+        """Send encrypted data to IOTA, returning the block ID and the node it was posted to"""
+        payload = payload or sensor_data.to_bytes() # Serialized once, reused for hashing, sizes and encryption
+        key = content_hash(payload)
+        posting = False
         try:
-            if not self.check_connection():
-                print("\nNetwork unavailable - storing data...")
-                self.save_pending_message(device_id, sensor_data) # Save message when offline
-                return None
+            with trace.span('health_check'):
+                node_available = self.check_connection()
+            if not node_available:
+                log.warning("Network unavailable - storing data...", extra={'device_id': device_id})
+                self.metrics.posts.labels('offline').inc()
+                self.save_pending_message(device_id, sensor_data, payload) # Save message when offline
+                trace.finish(status='spooled')
+                return None, None
 
             total_start_time = time.time()
             
             # Encrypt data
-            encrypted_data = self.encrypt_data(sensor_data) 
+            with trace.span('encrypt'):
+                encrypted_data = self.encrypt_data(payload) 
             if not encrypted_data:
-                return None
+                trace.finish(status='encrypt_failed')
+                return None, None
                 
-            original_size = len(json.dumps(sensor_data).encode()) # Original data size
+            original_size = len(payload) # Original data size
             encrypted_size = len(encrypted_data) # Encrypted data size
             
-            print(f"\nSending encrypted data to IOTA")
-            print(f"Original size: {original_size} bytes")
-            print(f"Encrypted size: {encrypted_size} bytes")
+            log.debug("Sending encrypted data to IOTA", extra={
+                'device_id': device_id, 'original_size': original_size, 'encrypted_size': encrypted_size})
             
             # Send to IOTA
             transmission_start = time.time()
-            block = self.iota_client.build_and_post_block( # Send encrypted data to IOTA
-                tag=utf8_to_hex('ENCRYPTED_SENSOR_DATA'),
-                data=utf8_to_hex(base64.b64encode(encrypted_data).decode())
-            )
+            self.ledger.begin(key)
+            posting = True
+            with trace.span('post') as post_span:
+                block, node_url = self.node_pool.post( # Send encrypted data to IOTA
+                    priority=priority == HIGH,
+                    tag=DATA_TAG,
+                    data='0x' + base64.b64encode(encrypted_data).hex() # Same hex text as before, without str round trips
+                )
+                post_span.set_attribute('node', node_url)
             transmission_time = time.time() - transmission_start
+            self.metrics.posts.labels('ok').inc()
+            self.metrics.post_latency.observe(transmission_time)
             
             total_time = time.time() - total_start_time
             
             block_id = block[0] # Get block ID
-            print(f'Block sent! ID: {block_id}')
+            self.ledger.posted(key, block_id)
+            log.info("Block sent! ID: %s", block_id, extra={'device_id': device_id, 'block_id': block_id})
             
             # Store encryption metrics
             self._store_encryption_metrics(
@@ -285,65 +628,190 @@ class Middleware:
                 total_time
             )
             
-            # Add to confirmation queue
-            self.confirmation_queue.put((block_id, ttn_time, device_id, sensor_data))
-            return block_id
+            return block_id, node_url
             
         except Exception as e:
-            print(f"Error sending to IOTA: {str(e)}")
-            self.save_pending_message(device_id, sensor_data)
+            log.error("Error sending to IOTA: %s", e, extra={'device_id': device_id})
+            self.metrics.posts.labels('throttled' if is_throttled(e) else 'error').inc()
+            trace.finish(status='error', error=str(e))
+            if posting:
+                self.ledger.failed(key, e) # Ambiguous failures are checked on the node before reposting
+            self.save_pending_message(device_id, sensor_data, payload)
+            return None, None
+
+    # Queue a reading for posting without blocking the MQTT thread
+    def submit_reading(self, sensor_data, ttn_time, device_id, trace=NOOP_TRACE, priority=NORMAL):
+        """Queue a reading for posting without blocking the MQTT thread"""
+        if priority == HIGH:
+            future = self.priority_executor.submit(self.anchor_reading, sensor_data, ttn_time, device_id, trace, priority)
+        else:
+            self._post_slots.acquire()  # Backpressure once POST_QUEUE_LIMIT readings are waiting
+            future = self.post_executor.submit(self.anchor_reading, sensor_data, ttn_time, device_id, trace)
+            future.add_done_callback(lambda _: self._post_slots.release())
+        self._posts_in_flight.add(future)
+        future.add_done_callback(self._posts_in_flight.discard)
+        future.add_done_callback(self._log_post_error)
+        return future
+
+    # Log an error raised while anchoring a reading, which would otherwise stay inside its future
+    def _log_post_error(self, future):
+        """Log an error raised while anchoring a reading"""
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Error anchoring reading: %s", future.exception())
+
+    # Priority class of a reading, counting high-priority ones
+    def classify(self, sensor_data):
+        """Priority class of a reading, counting high-priority ones"""
+        if not self.priority:
+            return NORMAL
+        priority, channel = self.priority.classify(sensor_data)
+        if priority == HIGH:
+            self.metrics.priority_readings.labels(channel).inc()
+        return priority
+
+    # Journal a posted block and queue it for confirmation, ahead of lower priorities
+    def queue_confirmation(self, priority, details):
+        """Journal a posted block and queue it for confirmation, ahead of lower priorities"""
+        block_id, ttn_time, device_id, _, node = details[:5]
+        self.confirmations.add(block_id, ttn_time, node, priority, device_id)
+        self.confirmation_queue.put((priority, next(self._confirmation_sequence), details))
+
+    # Queue the blocks left unconfirmed by the previous run, straight from the journal
+    def replay_confirmations(self):
+        """Queue the blocks left unconfirmed by the previous run, straight from the journal"""
+        start = time.perf_counter()
+        pending = self.confirmations.pending()
+        for block in pending:
+            self.confirmation_queue.put((block.priority, next(self._confirmation_sequence), (
+                block.block_id, block.ttn_time, block.device_id, None, block.node, NOOP_TRACE, NOOP_SPAN)))
+        if pending:
+            log.info("Replayed %d blocks waiting for confirmation in %.1f ms",
+                     len(pending), (time.perf_counter() - start) * 1000)
+
+    # Send a reading to IOTA, record it and monitor its confirmation
+    def anchor_reading(self, sensor_data, ttn_time, device_id, trace=NOOP_TRACE, priority=NORMAL):
+        """Send a reading to IOTA, record it and monitor its confirmation"""
+        payload = sensor_data.to_bytes()
+        key = content_hash(payload)
+        entry = self.ledger.get(key)
+        if entry and entry['state'] == POSTED:
+            log.info("Reading already anchored in block %s, not posting again", entry['block_id'],
+                     extra={'device_id': device_id, 'block_id': entry['block_id']})
+            self.metrics.reposts_avoided.inc()
+            trace.finish(status='duplicate', block_id=entry['block_id'])
+            return entry['block_id']
+        node_url = None
+        if entry and entry['state'] == FOUND:
+            # An earlier post that looked failed reached the node: record it instead of posting again
+            block_id = entry['block_id']
+            self.ledger.posted(key, block_id)
+            self.metrics.reposts_avoided.inc()
+        elif self.ledger.awaiting(key):
+            self.save_pending_message(device_id, sensor_data, payload) # Give the ambiguous post time to show up
+            trace.finish(status='awaiting')
+            return None
+        else:
+            block_id, node_url = self.send_to_iota(sensor_data, ttn_time, device_id, trace, payload, priority) # Send to IOTA
+        if not block_id:
+            log.warning("Failed to send to IOTA", extra={'device_id': device_id})
+            return None
+        with trace.span('store'):
+            self.store_data(block_id, sensor_data, ttn_time)
+        # Queued only once its row exists, so the confirmation always finds it
+        queue_span = trace.span('confirmation_queue')
+        self.queue_confirmation(priority, (block_id, ttn_time, device_id, sensor_data, node_url, trace, queue_span))
+        log.debug("Data sent to IOTA. Monitoring confirmation...", extra={'device_id': device_id, 'block_id': block_id})
+        return block_id
+
+    # Post a Merkle root and its batch metadata to IOTA
+    def post_merkle_root(self, root, metadata):
+        """Post a Merkle root and its batch metadata to IOTA"""
+        try:
+            if not self.check_connection():
+                log.warning("Network unavailable - Merkle window kept for the next attempt")
+                self.metrics.posts.labels('offline').inc()
+                return None
+            transmission_start = time.time()
+            block, node_url = self.node_pool.post(
+                tag=utf8_to_hex(MERKLE_TAG),
+                data=utf8_to_hex(json.dumps(metadata))
+            )
+            self.metrics.posts.labels('ok').inc()
+            self.metrics.post_latency.observe(time.time() - transmission_start)
+            self._merkle_nodes[block[0]] = node_url
+            return block[0]
+        except Exception as e:
+            log.error("Error posting Merkle root: %s", e)
+            self.metrics.posts.labels('error').inc()
             return None
 
+    # Readings of a Merkle window as encrypted delta/XOR-compressed series per device, for the root's metadata
+    def encode_merkle_series(self, readings):
+        """Readings of a Merkle window as encrypted delta/XOR-compressed series per device"""
+        from tscodec import encode_readings
+        series = {}
+        for device_id, data in encode_readings([SensorReading.from_dict(r) for r in readings]).items():
+            token = self.encrypt_data(data)
+            if not token:
+                return None
+            series[device_id] = token.decode()
+        size = sum(map(len, series.values()))
+        if size > Config.MERKLE_SERIES_MAX_BYTES:
+            log.warning("Merkle window series takes %d bytes, posting the root only", size)
+            return None
+        return series
+
+    # Record readings anchored under a Merkle root and monitor its confirmation
+    def on_merkle_anchored(self, block_id, entries):
+        """Record readings anchored under a Merkle root and monitor its confirmation"""
+        for sensor_data, ttn_time in entries:
+            self.store_data(block_id, SensorReading.from_dict(sensor_data), ttn_time)
+        first_ttn_time = min(ttn_time for _, ttn_time in entries)
+        node_url = self._merkle_nodes.pop(block_id, None)
+        self.queue_confirmation(NORMAL, (block_id, first_ttn_time, 'merkle-batch', None, node_url, NOOP_TRACE, NOOP_SPAN))
+
     # Process sensor data
-    def process_sensor_data(self, payload):
+    def process_sensor_data(self, payload, ttn_time=None):
         """Process TTN message into sensor data structure"""
         try:
-            return {
-                "deviceId": payload["end_device_ids"]["device_id"],
-                "timestamp": datetime.now().isoformat(),
-                "measurements": {
-                    "aht10_temperature": payload["uplink_message"]["decoded_payload"]["v0"],
-                    "aht10_humidity": payload["uplink_message"]["decoded_payload"]["v1"],
-                    "ds18b20_temperature": payload["uplink_message"]["decoded_payload"]["v2"],
-                    "light_level": payload["uplink_message"]["decoded_payload"]["v3"],
-                    "soil_moisture": payload["uplink_message"]["decoded_payload"]["v4"]
-                },
-                "metadata": {
-                    "rssi": payload["uplink_message"]["rx_metadata"][0]["rssi"],
-                    "snr": payload["uplink_message"]["rx_metadata"][0]["snr"],
-                    "frequency": payload["uplink_message"]["settings"]["frequency"],
-                    "gateway_id": payload["uplink_message"]["rx_metadata"][0]["gateway_ids"]["gateway_id"]
-                }
-            }
+            # Stamped with the journaled reception time, so a replayed uplink gives the same bytes and content hash
+            return SensorReading.from_uplink(payload, ttn_time)
         except Exception as e:
-            print(f"Error processing sensor data: {str(e)}")
+            log.error("Error processing sensor data: %s", e)
             return None
 
     # Check block confirmation
-    def check_block_confirmation(self, block_id, ttn_time, device_id, sensor_data):
+    def check_block_confirmation(self, block_id, ttn_time, device_id, sensor_data, node=None):
         """Check if block is confirmed in Tangle"""
         try:
-            response = requests.get(f"{Config.NODE_URL}/api/core/v2/blocks/{block_id}") # Check block confirmation
+            # Asked to the node that received the block, which knows it first
+            response = requests.get(f"{node or Config.NODE_URL}/api/core/v2/blocks/{block_id}") # Check block confirmation
             if response.status_code == 200: 
                 confirmation_time = time.time()
+                self.metrics.confirmation_latency.observe(confirmation_time - ttn_time)
+                self.live_stats.record_confirmation(device_id, confirmation_time - ttn_time)
                 self.store_data(block_id, sensor_data, ttn_time, confirmation_time) # Store confirmation details
+                if self.archive:
+                    self.archive.add_confirmation(block_id, device_id, ttn_time, confirmation_time)
                 return True
             return False
         except Exception as e:
-            print(f"Error checking block confirmation: {str(e)}")
+            log.error("Error checking block confirmation: %s", e)
             return False
 
     # Plot response times
     def plot_response_times(self):
         """Plot response time metrics"""
         try:
+            import matplotlib.pyplot as plt
+            import pandas as pd
+            from matplotlib.dates import DateFormatter, SecondLocator
+
             if not os.path.exists('iota_data.csv'):
-                print("No data file found.")
+                log.warning("No data file found.")
                 return
                 
-            df = pd.read_csv('iota_data.csv')
-            df['TTN time'] = pd.to_datetime(df['TTN time'])
-            df['Response time'] = pd.to_numeric(df['Response time'])
+            df = load_transactions(pd)
             
             mean_response = df['Response time'].mean()
 
@@ -365,149 +833,432 @@ class Middleware:
             
             plt.tight_layout()
             plt.savefig('response_times.png', dpi=300)
-            print(f"\nMean response time: {mean_response:.2f} seconds")
+            log.info("Mean response time: %.2f seconds", mean_response)
         except Exception as e:
-            print(f"Error creating graph: {str(e)}")
+            log.error("Error creating graph: %s", e)
 
     # Monitor block confirmations
     def confirmation_monitor(self):
         """Monitor block confirmations"""
-        while True:
+        while not self.confirmations_cutoff.is_set():
+            try:
+                priority, _, details = self.confirmation_queue.get(timeout=1) # Get confirmation details, highest priority first
+            except queue.Empty:
+                continue
             try:
-                block_id, ttn_time, device_id, sensor_data = self.confirmation_queue.get() # Get confirmation details
+                block_id, ttn_time, device_id, sensor_data, node, trace, queue_span = details
+                queue_span.end()
                 attempts = 0
+                status = 'unconfirmed'
                 while attempts < Config.MAX_RETRY_ATTEMPTS: 
-                    if self.check_block_confirmation(block_id, ttn_time, device_id, sensor_data): # Check block confirmation
+                    if self.confirmations_cutoff.is_set():
+                        status = 'persisted' # Left in the journal and confirmed on the next run
                         break
-                    time.sleep(Config.VERIFICATION_INTERVAL)
+                    with trace.span('confirmation_poll', attempt=attempts) as poll_span:
+                        confirmed = self.check_block_confirmation(block_id, ttn_time, device_id, sensor_data, node) # Check block confirmation
+                        poll_span.set_attribute('confirmed', confirmed)
+                    if confirmed:
+                        status = 'confirmed'
+                        break
+                    self.confirmations_cutoff.wait(Config.VERIFICATION_INTERVAL)
                     attempts += 1
-                if attempts >= Config.MAX_RETRY_ATTEMPTS:
-                    print(f"Block {block_id} not confirmed after 30 seconds")
+                if status == 'unconfirmed':
+                    log.warning("Block %s not confirmed after 30 seconds", block_id, extra={'device_id': device_id, 'block_id': block_id})
+                if status != 'persisted':
+                    self.confirmations.close(block_id)
+                trace.finish(status=status, block_id=block_id)
             except Exception as e:
-                print(f"Error in confirmation monitor: {str(e)}")
+                log.error("Error in confirmation monitor: %s", e)
             finally:
                 self.confirmation_queue.task_done()
 
     # Retry sending pending messages
     def retry_monitor(self):
         """Monitor and retry sending pending messages"""
-        while True:
+        last_prune = time.time()
+        while not self.stopping.is_set():
             try:
+                if time.time() - last_prune >= Config.LEDGER_PRUNE_INTERVAL:
+                    last_prune = time.time()
+                    self.ledger.prune() # Expired posted readings are dropped while running, not only on restart
                 if self.check_connection(): # Check network connection
-                    pending_messages = self.load_pending_messages() # Load pending messages
+                    with self.storage_lock:
+                        pending_messages = self.load_pending_messages() # Load pending messages
+                        # Ambiguous posts stay spooled until they show up on the node or their grace period ends
+                        awaiting = [m for m in pending_messages if self.ledger.awaiting(content_hash(m['sensor_data'].encode()))]
+                        if len(awaiting) < len(pending_messages):
+                            pending_messages = [m for m in pending_messages if m not in awaiting]
+                            self._rewrite_pending(awaiting) # Messages that fail again are spooled again
+                        else:
+                            pending_messages = []
                     
                     if pending_messages:
-                        print("\nConnection available - sending pending messages...")
+                        log.info("Connection available - sending pending messages...")
                         
-                        for message in pending_messages: # Retry sending pending messages
-                            sensor_data = json.loads(message['sensor_data']) # Load sensor data
-                            if self.send_to_iota(sensor_data, time.time(), message['device_id']):
-                                continue
-                        
-                        if self.pending_data_file.exists(): 
-                            self.pending_data_file.unlink() # Remove pending messages file
-                            print("Pending messages processed")
+                        readings = [
+                            (SensorReading.from_dict(json.loads(message['sensor_data'])), message['device_id'])
+                            for message in pending_messages
+                        ]
+                        futures = [
+                            self.submit_reading(
+                                reading, time.time(), device_id,
+                                priority=self.priority.classify(reading)[0] if self.priority else NORMAL)
+                            for reading, device_id in readings # Retry sending pending messages in parallel
+                        ]
+                        wait(futures)
+                        log.info("Pending messages processed")
                 
-                time.sleep(Config.VERIFICATION_INTERVAL)
+                self.stopping.wait(Config.VERIFICATION_INTERVAL)
                 
             except Exception as e:
-                print(f"Error in retry monitor: {str(e)}")
+                log.error("Error in retry monitor: %s", e)
+
+    # Watch the node for our tagged blocks, so ambiguous posts are found instead of reposted
+    def watch_node_blocks(self):
+        """Watch the node for our tagged blocks, so ambiguous posts are found instead of reposted"""
+        try:
+            from iota_sdk import Client
+            self.block_watcher = Client(nodes=Config.NODE_URLS)
+            self.block_watcher.listen_mqtt(
+                [f"blocks/tagged-data/{DATA_TAG}"], self.on_node_block)
+        except Exception as e:
+            log.error("Error watching node blocks: %s", e)
+
+    # Match a block seen on the node with a reading whose post looked failed
+    def on_node_block(self, event):
+        """Match a block seen on the node with a reading whose post looked failed"""
+        try:
+            from iota_sdk import Block, Utils
+            block = json.loads(event)['payload']
+            if isinstance(block, str):
+                block = json.loads(block)
+            data = block['payload']['data']
+            # Only blocks encrypted with this middleware's key decrypt; others are from other middlewares
+            token = base64.b64decode(bytes.fromhex(data[2:]))
+            try:
+                payload = self.cipher_suite.decrypt(token)
+            except Exception:
+                return
+            block_id = Utils.block_id(Block.from_dict(block))
+            # Posts still in progress are often seen here first; only failed-looking ones are worth a line
+            if self.ledger.found(content_hash(payload), block_id) in (AMBIGUOUS, FAILED):
+                log.info("Block %s found on the node for a reading whose post failed", block_id,
+                         extra={'device_id': json.loads(payload).get('deviceId'), 'block_id': block_id})
+        except Exception as e:
+            log.error("Error matching node block: %s", e)
 
     # Monitor connection status
     def connection_monitor(self):
         """Monitor connection status"""
         last_status = True
         
-        while True:
+        while not self.stopping.is_set():
             try:
                 current_status = self.check_connection() # Check network connection
                 self.connection_status = current_status # Update connection status
+                self.metrics.node_up.labels(Config.NODE_URL).set(1 if current_status else 0)
                 
                 if current_status != last_status: 
                     if not current_status:
-                        print("\n--> Connection lost <--")
+                        log.warning("--> Connection lost <--")
                     else:
-                        print("\n--> Connection restored <--")
+                        log.info("--> Connection restored <--")
                     
                     last_status = current_status
                 
-                time.sleep(Config.VERIFICATION_INTERVAL)
+                self.stopping.wait(Config.VERIFICATION_INTERVAL)
                 
             except Exception as e:
-                print(f"Error in connection monitor: {str(e)}")
+                log.error("Error in connection monitor: %s", e)
                 self.connection_status = False
+                self.metrics.node_up.labels(Config.NODE_URL).set(0)
 
     # Callback for MQTT client connection
     def on_connect(self, client, userdata, flags, rc):
         """Callback when connected to TTN"""
         if rc == 0:
-            print("Connected to TTN successfully!")
-            topic = f"v3/{Config.TTN_APP_ID}@ttn/devices/+/up" # TTN topic
-            client.subscribe(topic) # Subscribe to TTN topic
-            print(f"Subscribed to topic: {topic}")
+            log.info("Connected to TTN successfully! (session present: %s)", bool(flags.get('session present')))
+            self.mqtt_backoff.reset()
+            if self._disconnected_at is not None:
+                self.metrics.mqtt_reconnect_time.observe(time.time() - self._disconnected_at)
+                self._disconnected_at = None
+            topic = uplink_topic() # TTN topic
+            client.subscribe(topic, qos=1) # QoS 1: uplinks are redelivered until acknowledged
+            log.info("Subscribed to topic: %s", topic)
+            if not self.startup.reported:
+                self.startup.mark('mqtt connect')
+                # Wait for background initialization before the first uplink
+                self._node_pool_future.result()
+                self._cipher_suite_future.result()
+                self.startup.mark('wait for background init')
+                self.startup.report()
         else:
-            print(f"Failed to connect to TTN, return code: {rc}")
+            log.error("Failed to connect to TTN, return code: %s", rc)
+
+    # Callback when the connection to TTN drops
+    def on_disconnect(self, client, userdata, rc):
+        """Callback when the connection to TTN drops"""
+        if rc != 0:
+            log.warning("Disconnected from TTN, return code: %s", rc)
+            self.metrics.mqtt_disconnects.inc()
+            if self._disconnected_at is None:
+                self._disconnected_at = time.time()
 
     # Callback for incoming MQTT messages
     def on_message(self, client, userdata, msg):
         """Process incoming TTN messages"""
+        # Uplinks of devices owned by other shards are dropped from the topic, before decoding
+        if self.ring and self.ring.shard_for(topic_device(msg.topic) or '') != Config.SHARD_ID:
+            return
+        ttn_time = getattr(msg, 'received_at', None) or time.time() # Set by the receiver in multiprocess mode
+        # Journaled before returning: paho sends the QoS 1 PUBACK only after this callback
         try:
-            print("\n=== New message received ===")
-            ttn_time = time.time()
-            
-            payload = json.loads(msg.payload.decode()) # Load message payload
-            device_id = payload['end_device_ids']['device_id']
-            
-            if 'uplink_message' in payload and 'decoded_payload' in payload['uplink_message']:
-                sensor_data = self.process_sensor_data(payload) # Process sensor data
-                if sensor_data:
-                    block_id = self.send_to_iota(sensor_data, ttn_time, device_id) # Send to IOTA
-                    if block_id:
-                        self.store_data(block_id, sensor_data, ttn_time)
-                        print(f"Data sent to IOTA. Monitoring confirmation...")
-                    else:
-                        print("Failed to send to IOTA")
+            seq = self.inbox.append(Uplink(msg.topic, msg.payload, ttn_time))
+        except Exception as e:
+            log.error("Error journaling uplink: %s", e)
+            raise  # Drops the connection without acknowledging, so the broker redelivers it
+        future = None
+        try:
+            future = self.handle_uplink(msg, ttn_time)
         except Exception as e:
-            print(f"Error processing message: {str(e)}")
+            log.error("Error processing message: %s", e)
+        finally:
+            self._finish_uplink(seq, future)
+
+    # Clear an uplink from the journal once its reading is stored, spooled or discarded
+    def _finish_uplink(self, seq, future):
+        """Clear an uplink from the journal once its reading is stored, spooled or discarded"""
+        if future is not None:
+            # Posts cancelled on shutdown or failed with an error stay in the journal and are replayed on the next run
+            future.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or self.inbox.done(seq))
+        else:
+            self.inbox.done(seq)
+
+    # Process uplinks left unfinished by a previous run
+    def replay_inbox(self):
+        """Process uplinks left unfinished by a previous run"""
+        for seq, uplink in self.inbox.unfinished():
+            future = None
+            try:
+                future = self.handle_uplink(uplink, uplink.received_at, replay=True)
+            except Exception as e:
+                log.error("Error replaying uplink: %s", e)
+            finally:
+                self._finish_uplink(seq, future)
+
+    # Decode, filter and dispatch one uplink, returning the posting future if it was submitted
+    def handle_uplink(self, msg, ttn_time, replay=False):
+        """Decode, filter and dispatch one uplink, returning the posting future if it was submitted"""
+        self.metrics.uplinks_received.inc()
+        trace = self.tracer.start_trace('uplink', topic=msg.topic)
+        
+        try:
+            with trace.span('decode'):
+                payload = json.loads(msg.payload.decode()) # Load message payload
+                device_id = payload['end_device_ids']['device_id']
+        except (ValueError, KeyError, TypeError):
+            self.metrics.decode_failures.inc()
+            trace.finish(status='decode_failed')
+            raise
+        
+        if 'uplink_message' in payload and 'decoded_payload' in payload['uplink_message']:
+            # Drop redeliveries and multi-gateway copies before encrypting and posting
+            # (replayed uplinks were already recorded as seen before the previous run stopped)
+            if not replay and self.dedup.seen(uplink_key(payload)):
+                self.metrics.duplicates_dropped.inc()
+                log.debug("Duplicate uplink dropped", extra={'device_id': device_id})
+                trace.finish(status='duplicate', device_id=device_id)
+                return
+            with trace.span('process'):
+                sensor_data = self.process_sensor_data(payload, ttn_time) # Process sensor data
+            if not sensor_data:
+                self.metrics.decode_failures.inc()
+                trace.finish(status='decode_failed', device_id=device_id)
+            else:
+                trace.set_attribute('device_id', device_id)
+                self.live_stats.record_uplink(device_id)
+                self.record_locally(sensor_data)
+                # Alarm readings skip the dead-band and batching and go straight to their own lane
+                priority = self.classify(sensor_data)
+                if priority == HIGH:
+                    trace.set_attribute('priority', 'high')
+                    log.info("High-priority reading", extra={'device_id': device_id})
+                elif self.deadband:
+                    anchor, reason = self.deadband.check(device_id, sensor_data.measurements(), ttn_time)
+                    if not anchor:
+                        self.metrics.readings_filtered.inc()
+                        self.store_filtered_data(sensor_data, ttn_time) # Keep reading locally
+                        trace.finish(status='filtered', device_id=device_id)
+                        return
+                    trace.set_attribute('anchor_reason', reason)
+                if self.merkle and priority != HIGH:
+                    self.merkle.add(sensor_data.to_dict(), ttn_time) # Stored locally, anchored with its window
+                    trace.finish(status='batched', device_id=device_id)
+                    return
+                log.debug("New message received", extra={'device_id': device_id, 'trace_id': trace.trace_id})
+                return self.submit_reading(sensor_data, ttn_time, device_id, trace, priority) # Send to IOTA
+        else:
+            trace.finish(status='no_payload')
+
+    # Add a reading to the in-memory recent readings and the rollups
+    def record_locally(self, sensor_data):
+        """Add a reading to the in-memory recent readings and the rollups"""
+        # Local views only: a failure here must not stop the reading from being anchored
+        if self.recent:
+            try:
+                self.recent.record(sensor_data)
+            except Exception as e:
+                log.error("Error recording recent reading: %s", e)
+        if self.rollups:
+            try:
+                self.rollups.add(sensor_data)
+            except Exception as e:
+                log.error("Error updating rollups: %s", e)
+
+    # Start the monitor threads and the HTTP server
+    def start_services(self):
+        """Start the monitor threads and the HTTP server"""
+        self.replay_confirmations()
+        for _ in range(Config.CONFIRMATION_WORKERS):
+            Thread(target=self.confirmation_monitor, daemon=True).start()
+        self._retry_thread = Thread(target=self.retry_monitor, daemon=True)
+        self._retry_thread.start()
+        Thread(target=self.connection_monitor, daemon=True).start()
+        if self.merkle:
+            self._merkle_thread = Thread(target=self.merkle.run, args=(self.stopping,), daemon=True)
+            self._merkle_thread.start()
+        Thread(target=self.watch_node_blocks, daemon=True).start()
+        self.replay_inbox()
+        
+        # Expose metrics and the live dashboard over HTTP
+        if Config.HTTP_PORT:
+            self.http_server = LocalServer(Config.HTTP_HOST, Config.HTTP_PORT)
+            self.http_server.add_route('/metrics', self.metrics.handle_request)
+            Dashboard(self.live_stats).register(self.http_server)
+            if self.recent:
+                from recent import RecentReadingsAPI
+                RecentReadingsAPI(self.recent).register(self.http_server)
+            if self.rollups:
+                self.http_server.add_route('/api/rollups', self.rollups.handle_request)
+            self.http_server.start()
+        
+        self.startup.mark('monitors and http server')
 
     # Start the middleware
     def start(self):
         """Start the middleware"""
+        client = None
         try:
-            print("\nStarting TTN to IOTA middleware with encryption and connection handling...")
-            
-            # Start monitor threads
-            Thread(target=self.confirmation_monitor, daemon=True).start()
-            Thread(target=self.retry_monitor, daemon=True).start()
-            Thread(target=self.connection_monitor, daemon=True).start()
+            log.info("Starting TTN to IOTA middleware with encryption and connection handling...")
+            self.start_services()
             
             # Setup MQTT client
-            client = mqtt.Client(client_id=f"python-bridge-{Config.TTN_APP_ID}-{int(time.time())}")
+            client = persistent_client(Config.MQTT_CLIENT_ID)
             client.username_pw_set(Config.TTN_APP_ID, Config.TTN_API_KEY)
             client.tls_set()
             
             client.on_connect = self.on_connect
+            client.on_disconnect = self.on_disconnect
             client.on_message = self.on_message
             
-            print("\nConnecting to TTN...")
-            client.connect(Config.TTN_BROKER, Config.TTN_PORT, 60)
-            
-            print("Starting MQTT loop...")
-            client.loop_forever()
+            log.info("Connecting to TTN...")
+            log.info("Starting MQTT loop...")
+            run_forever(client, Config.TTN_BROKER, Config.TTN_PORT, self.mqtt_backoff)
             
         except KeyboardInterrupt:
-            print("\nShutting down...")
-            self.plot_response_times()
+            log.info("Shutting down...")
         except Exception as e:
-            print(f"\nError in middleware: {str(e)}")
+            log.error("Error in middleware: %s", e)
         finally:
-            client.disconnect()
+            if client:
+                client.disconnect() # Stop intake; the broker keeps new uplinks in the session
+            self.shutdown()
+
+    # Wait for a condition until the deadline, reporting progress every second
+    def _drain(self, what, remaining, deadline):
+        """Wait for a condition until the deadline, reporting progress every second"""
+        reported = 0
+        while remaining() and time.time() < deadline:
+            if time.time() - reported >= 1:
+                log.info("Shutdown: %d %s pending, %.0f s left", remaining(), what, deadline - time.time())
+                reported = time.time()
+            time.sleep(0.1)
+        return remaining()
+
+    # Stop in order: finish posting, anchor open batches, wait for confirmations and persist what is left
+    def shutdown(self):
+        """Stop in order: finish posting, anchor open batches, wait for confirmations and persist what is left"""
+        deadline = time.time() + Config.SHUTDOWN_DEADLINE
+        log.info("Shutdown: intake stopped, draining for up to %.0f s", Config.SHUTDOWN_DEADLINE)
+        self.stopping.set()  # Monitors stop retrying and Merkle windows stop rotating
+
+        # Finish the retry pass in progress, then the posts already accepted
+        retry_thread = getattr(self, '_retry_thread', None)
+        if retry_thread:
+            retry_thread.join(max(0.0, deadline - time.time()))
+        left = self._drain('posts', lambda: len(self._posts_in_flight), deadline)
+        self.post_executor.shutdown(wait=False, cancel_futures=True)
+        self.priority_executor.shutdown(wait=False, cancel_futures=True)
+        if left:
+            log.warning("Shutdown: %d posts cancelled, their uplinks are replayed on the next run", left)
+
+        # Anchor the open Merkle window (a flush already running in the monitor finishes first)
+        if self.merkle:
+            merkle_thread = getattr(self, '_merkle_thread', None)
+            if merkle_thread:
+                merkle_thread.join(max(0.0, deadline - time.time()))
+            try:
+                self.merkle.flush()
+            except Exception as e:
+                log.error("Error anchoring Merkle window: %s", e)
+
+        # Confirmations get the rest of the deadline; the blocks still unconfirmed stay journaled for the next run
+        self._drain('confirmations', lambda: self.confirmation_queue.unfinished_tasks, deadline)
+        self.confirmations_cutoff.set()
+        while True:
+            try:
+                self.confirmation_queue.get_nowait()
+                self.confirmation_queue.task_done()
+            except queue.Empty:
+                break
+        self._drain('confirmation polls', lambda: self.confirmation_queue.unfinished_tasks, time.time() + 5)
+        if self.confirmations.depth():
+            log.info("Shutdown: %d blocks waiting for confirmation kept in %s",
+                     self.confirmations.depth(), Config.CONFIRMATION_JOURNAL)
+
+        if self.rollups:
+            self.rollups.flush()
+        if self.archive:
+            self.archive.close(max(1.0, deadline - time.time()))
+        self.tracer.flush(max(1.0, deadline - time.time()))
+        if self.http_server:
+            self.http_server.stop()
+        if self.block_builder:
+            self.block_builder.shutdown()
+        if Config.PLOT_ON_SHUTDOWN:
+            self.plot_response_times()
+        log.info("Shutdown complete")
 
 # Main entry point
 def main():
     """Main entry point"""
-    middleware = Middleware()
-    middleware.start()
+    # Every process of a cluster keeps its spool, ledger and results in its own directory
+    os.makedirs(Config.DATA_DIR, exist_ok=True)
+    os.chdir(Config.DATA_DIR)
+    log_listener = setup_logging(
+        Config.LOG_LEVEL, Config.LOG_FILE,
+        error_burst=Config.LOG_ERROR_BURST,
+        error_interval=Config.LOG_ERROR_INTERVAL,
+        device_sample=Config.LOG_DEVICE_SAMPLE
+    )
+    try:
+        if Config.WORKER_PROCESSES > 1:
+            import multiproc
+            multiproc.run(Config.WORKER_PROCESSES)
+        else:
+            Middleware().start()
+    finally:
+        log_listener.stop()  # Flush queued log records
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
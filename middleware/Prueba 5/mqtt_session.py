@@ -0,0 +1,52 @@
+import logging
+import random
+import time
+
+import paho.mqtt.client as mqtt
+
+log = logging.getLogger('middleware.mqtt')
+
+
+# Exponential reconnect backoff with full jitter, so a cluster does not reconnect in lockstep
+class ReconnectBackoff:
+    def __init__(self, initial=0.5, maximum=60.0, multiplier=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.attempt = 0
+
+    # Delay before the next reconnect attempt
+    def next(self):
+        """Delay before the next reconnect attempt"""
+        ceiling = min(self.maximum, self.initial * self.multiplier ** self.attempt)
+        self.attempt += 1
+        return random.uniform(self.initial / 10, ceiling)
+
+    # Start again from the shortest delay after a successful connection
+    def reset(self):
+        """Start again from the shortest delay after a successful connection"""
+        self.attempt = 0
+
+
+# MQTT client with a persistent session (stable id, no clean session)
+def persistent_client(client_id):
+    """MQTT client with a persistent session (stable id, no clean session)"""
+    return mqtt.Client(client_id=client_id, clean_session=False)
+
+
+# Run the MQTT network loop, reconnecting with jittered backoff whenever the connection drops
+def run_forever(client, host, port, backoff, keepalive=60):
+    """Run the MQTT network loop, reconnecting with jittered backoff whenever the connection drops"""
+    client.connect_async(host, port, keepalive)
+    while True:
+        try:
+            client.reconnect()
+            rc = mqtt.MQTT_ERR_SUCCESS
+            while rc == mqtt.MQTT_ERR_SUCCESS:
+                rc = client.loop(timeout=1.0)
+            log.warning("MQTT connection lost: %s", mqtt.error_string(rc))
+        except OSError as e:
+            log.warning("MQTT connection failed: %s", e)
+        delay = backoff.next()
+        log.info("Reconnecting to MQTT in %.1f seconds", delay)
+        time.sleep(delay)
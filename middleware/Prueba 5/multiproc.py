@@ -0,0 +1,144 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from pathlib import Path
+from threading import Thread
+
+from cluster import HashRing, topic_device, merge_file, MERGED_FILES
+from inbox import Uplink, UplinkJournal
+from json_logging import setup_logging
+from middlewareFinal import Config, Middleware, uplink_topic
+from mqtt_session import ReconnectBackoff, persistent_client, run_forever
+
+log = logging.getLogger('middleware.multiproc')
+
+
+# Worker process: its own middleware, crypto context and IOTA clients, fed from the receiver
+def _worker(index, inbox, handed_over):
+    """Worker process: its own middleware, crypto context and IOTA clients, fed from the receiver"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The receiver coordinates shutdown
+    directory = Path(f"worker-{index}")
+    directory.mkdir(exist_ok=True)
+    os.chdir(directory)
+    if Config.HTTP_PORT:
+        Config.HTTP_PORT += 1 + index  # Receiver port + 1 + worker index
+    log_listener = setup_logging(
+        Config.LOG_LEVEL, Config.LOG_FILE,
+        error_burst=Config.LOG_ERROR_BURST,
+        error_interval=Config.LOG_ERROR_INTERVAL,
+        device_sample=Config.LOG_DEVICE_SAMPLE
+    )
+    try:
+        middleware = Middleware()
+        middleware.start_services()
+        # Finish background initialization before the first uplink
+        middleware._node_pool_future.result()
+        middleware._cipher_suite_future.result()
+        log.info("Worker %d ready", index)
+        while True:
+            item = inbox.get()
+            if item is None:
+                break
+            seq, *uplink = item
+            try:
+                middleware.on_message(None, None, Uplink(*uplink))
+            except Exception:
+                continue  # Not journaled here: the receiver keeps it and replays it on the next start
+            handed_over.put(seq)  # Now in the worker's own journal, so the receiver can forget it
+        middleware.shutdown()
+        log.info("Worker %d stopped", index)
+    finally:
+        log_listener.stop()
+
+
+# Receive uplinks and fan them out to worker processes by device
+def run(processes):
+    """Receive uplinks and fan them out to worker processes by device"""
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue(maxsize=Config.POST_QUEUE_LIMIT) for _ in range(processes)]
+    handed_over = context.Queue()  # Sequence numbers of uplinks the workers have journaled
+    workers = [
+        context.Process(target=_worker, args=(i, inbox, handed_over), name=f"worker-{i}")
+        for i, inbox in enumerate(inboxes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Uplinks are journaled here before they are acknowledged, and cleared once a worker has journaled them
+    journal = UplinkJournal(Config.INBOX_FILE, Config.INBOX_FSYNC)
+
+    def clear_handed_over():
+        while (seq := handed_over.get()) is not None:
+            journal.done(seq)
+
+    clearer = Thread(target=clear_handed_over, name='handed-over', daemon=True)
+    clearer.start()
+
+    # Devices stick to one worker, so their readings keep their order and per-device state
+    worker_ring = HashRing(processes, name='worker')
+    shard_ring = HashRing(Config.SHARD_COUNT) if Config.CLUSTER_MODE == 'hash' else None
+
+    def dispatch(seq, uplink):
+        # Blocks when the worker is saturated, which holds back the MQTT loop
+        inboxes[worker_ring.shard_for(topic_device(uplink.topic) or '')].put(
+            (seq, uplink.topic, uplink.payload, uplink.received_at))
+
+    # Uplinks acknowledged by a previous run but never handed over to a worker
+    unfinished = journal.unfinished()
+    for seq, uplink in unfinished:
+        dispatch(seq, uplink)
+    if unfinished:
+        log.info("Replayed %d uplinks not handed over to a worker", len(unfinished))
+
+    backoff = ReconnectBackoff(Config.MQTT_RECONNECT_MIN, Config.MQTT_RECONNECT_MAX)
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            backoff.reset()
+            client.subscribe(uplink_topic(), qos=1)
+            log.info("Receiver subscribed, fanning out to %d workers", processes)
+        else:
+            log.error("Failed to connect to TTN, return code: %s", rc)
+
+    def on_message(client, userdata, msg):
+        device_id = topic_device(msg.topic) or ''
+        if shard_ring and shard_ring.shard_for(device_id) != Config.SHARD_ID:
+            return
+        uplink = Uplink(msg.topic, msg.payload, time.time())
+        # Journaled before returning: paho sends the QoS 1 PUBACK only after this callback
+        try:
+            seq = journal.append(uplink)
+        except Exception as e:
+            log.error("Error journaling uplink: %s", e)
+            raise  # Drops the connection without acknowledging, so the broker redelivers it
+        dispatch(seq, uplink)
+
+    client = persistent_client(Config.MQTT_CLIENT_ID)
+    client.username_pw_set(Config.TTN_APP_ID, Config.TTN_API_KEY)
+    client.tls_set()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    try:
+        run_forever(client, Config.TTN_BROKER, Config.TTN_PORT, backoff)
+    except KeyboardInterrupt:
+        log.info("Shutting down workers...")
+    finally:
+        client.disconnect()
+        for inbox in inboxes:
+            inbox.put(None)
+        for worker in workers:
+            worker.join()
+        handed_over.put(None)
+        clearer.join()
+        collect([f"worker-{i}" for i in range(processes)])
+
+
+# Merge the results of the workers in timestamp order
+def collect(worker_dirs, out_dir='collected'):
+    """Merge the results of the workers in timestamp order"""
+    for name in MERGED_FILES:
+        count = merge_file(name, worker_dirs, Path(out_dir))
+        if count:
+            log.info("Collected %d rows into %s/%s", count, out_dir, name)
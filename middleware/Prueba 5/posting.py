@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger('middleware.posting')
+
+
+# Whether a node error means the client is being throttled
+def is_throttled(error):
+    """Whether a node error means the client is being throttled"""
+    text = str(error).lower()
+    return '429' in text or 'too many requests' in text or 'rate limit' in text
+
+
+# Token bucket limiting a post rate while allowing short bursts
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate  # Tokens per second
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Take a token, sleeping until it is available, and return the time waited
+    def acquire(self, priority=False):
+        """Take a token, sleeping until it is available, and return the time waited"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens go negative to reserve future ones, so waiters are served in order
+            self.tokens -= 1
+            wait = 0.0 if priority or self.tokens >= 0 else -self.tokens / self.rate
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    # Seconds a new post would wait for its token
+    def delay(self):
+        """Seconds a new post would wait for its token"""
+        tokens = min(self.burst, self.tokens + (time.monotonic() - self._last) * self.rate)
+        return max(0.0, 1 - tokens) / self.rate
+
+
+# Additive-increase/multiplicative-decrease concurrency limit for one node
+class AIMDLimit:
+    def __init__(self, initial=2, minimum=1, maximum=32, latency_target=2.0, backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target  # Posts slower than this count as congestion
+        self.backoff = backoff
+        self.inflight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    # Wait for a free slot under the current limit (high-priority posts never wait)
+    def acquire(self, priority=False):
+        """Wait for a free slot under the current limit (high-priority posts never wait)"""
+        with self._condition:
+            while not priority and self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+
+    # Free a slot and adapt the limit to the outcome of the post
+    def release(self, latency, ok, throttled=False):
+        """Free a slot and adapt the limit to the outcome of the post"""
+        with self._condition:
+            self.inflight -= 1
+            now = time.monotonic()
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)  # About +1 per round trip
+            elif now - self._last_decrease >= self.latency_target or throttled:
+                # Decrease at most once per round trip, unless the node is explicitly throttling
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._last_decrease = now
+            self._condition.notify_all()
+
+    # Share of the limit currently in use
+    def load(self):
+        """Share of the limit currently in use"""
+        return self.inflight / int(self.limit)
+
+
+# IOTA nodes with their own clients and adaptive concurrency limits
+class NodePool:
+    def __init__(self, clients, initial=2, minimum=1, maximum=32, latency_target=2.0,
+                 node_rate=0, node_burst=1, app_bucket=None, on_rate_wait=None):
+        self.clients = clients  # node url -> iota_sdk Client
+        self.limits = {
+            url: AIMDLimit(initial, minimum, maximum, latency_target)
+            for url in clients
+        }
+        # Optional post rate per node (0 disables) and for the whole application
+        self.buckets = {url: TokenBucket(node_rate, node_burst) for url in clients} if node_rate else {}
+        self.app_bucket = app_bucket
+        self.on_rate_wait = on_rate_wait  # (limiter, seconds) after each rate-limited post
+
+    # Client of the first configured node
+    @property
+    def primary(self):
+        """Client of the first configured node"""
+        return next(iter(self.clients.values()))
+
+    # Take a token from a rate limiter and report the wait
+    def _wait_rate(self, limiter, bucket, priority):
+        """Take a token from a rate limiter and report the wait"""
+        waited = bucket.acquire(priority)
+        if self.on_rate_wait:
+            self.on_rate_wait(limiter, waited)
+
+    # Post a block on the least loaded node, keeping within its limit
+    def post(self, priority=False, **block_options):
+        """Post a block on the least loaded node, keeping within its limit"""
+        # High-priority posts take their tokens without waiting, delaying the posts behind them
+        if self.app_bucket:
+            self._wait_rate('app', self.app_bucket, priority)
+        # Rate-limited nodes are picked by how soon they accept a post, then by load
+        url = min(self.limits, key=lambda u: (self.buckets[u].delay() if self.buckets else 0, self.limits[u].load()))
+        limit = self.limits[url]
+        if self.buckets:
+            self._wait_rate('node', self.buckets[url], priority)
+        limit.acquire(priority)  # High-priority posts are bounded by their own executor instead
+        start = time.monotonic()
+        try:
+            block = self.clients[url].build_and_post_block(**block_options)
+        except Exception as e:
+            throttled = is_throttled(e)
+            limit.release(time.monotonic() - start, ok=False, throttled=throttled)
+            if throttled:
+                log.warning("Node %s is throttling, concurrency limit now %.1f", url, limit.limit)
+            raise
+        limit.release(time.monotonic() - start, ok=True)
+        return block, url
@@ -0,0 +1,30 @@
+from reading import CHANNELS
+
+# Priority classes (lower values are served first)
+HIGH = 0
+NORMAL = 1
+
+
+# Classifies readings as high priority when a channel leaves its allowed range
+class PriorityClassifier:
+    def __init__(self, rules):
+        # rules: {"default": {channel: {"min": x, "max": y}}, "<device_id>": {channel: {...}}}
+        self.default = rules.get('default', {})
+        self.per_device = {k: v for k, v in rules.items() if k != 'default'}
+
+    # Allowed range of each channel for a device
+    def rules_for(self, device_id):
+        """Allowed range of each channel for a device"""
+        return {**self.default, **self.per_device.get(device_id, {})}
+
+    # Priority of a reading and the channel that raised it
+    def classify(self, reading):
+        """Priority of a reading and the channel that raised it"""
+        rules = self.rules_for(reading.device_id)
+        for channel, value in zip(CHANNELS, reading.values):
+            limits = rules.get(channel)
+            if not limits or value is None:
+                continue
+            if value < limits.get('min', float('-inf')) or value > limits.get('max', float('inf')):
+                return HIGH, channel
+        return NORMAL, None
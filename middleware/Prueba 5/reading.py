@@ -0,0 +1,124 @@
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime
+
+# Measurement channels, in the order of the decoded payload fields v0..v4
+CHANNELS = ('aht10_temperature', 'aht10_humidity', 'ds18b20_temperature', 'light_level', 'soil_moisture')
+
+
+# Compact sensor reading passed through the pipeline (dicts and strings only at the edges)
+class SensorReading:
+    __slots__ = ('device_id', 'timestamp', 'values', 'rssi', 'snr', 'frequency', 'gateway_id')
+
+    def __init__(self, device_id, timestamp, values, rssi=None, snr=None, frequency=None, gateway_id=None):
+        self.device_id = device_id
+        self.timestamp = timestamp  # Epoch seconds
+        self.values = tuple(values)  # One value per channel in CHANNELS
+        self.rssi = rssi
+        self.snr = snr
+        self.frequency = frequency
+        self.gateway_id = gateway_id
+
+    # Build a reading from a TTN uplink
+    @classmethod
+    def from_uplink(cls, payload, timestamp=None):
+        """Build a reading from a TTN uplink"""
+        uplink = payload["uplink_message"]
+        decoded = uplink["decoded_payload"]
+        rx = uplink["rx_metadata"][0]
+        return cls(
+            payload["end_device_ids"]["device_id"],
+            time.time() if timestamp is None else timestamp,
+            (decoded["v0"], decoded["v1"], decoded["v2"], decoded["v3"], decoded["v4"]),
+            rx["rssi"], rx["snr"], uplink["settings"]["frequency"], rx["gateway_ids"]["gateway_id"]
+        )
+
+    # Build a reading from its JSON document
+    @classmethod
+    def from_dict(cls, data):
+        """Build a reading from its JSON document"""
+        metadata = data.get("metadata", {})
+        return cls(
+            data["deviceId"],
+            datetime.fromisoformat(data["timestamp"]).timestamp(),
+            tuple(data["measurements"].get(channel) for channel in CHANNELS),
+            metadata.get("rssi"), metadata.get("snr"), metadata.get("frequency"), metadata.get("gateway_id")
+        )
+
+    # Measurements by channel name
+    def measurements(self):
+        """Measurements by channel name"""
+        return dict(zip(CHANNELS, self.values))
+
+    # ISO timestamp of the reading
+    def isoformat(self):
+        """ISO timestamp of the reading"""
+        return datetime.fromtimestamp(self.timestamp).isoformat()
+
+    # JSON document of the reading, as anchored on IOTA
+    def to_dict(self):
+        """JSON document of the reading, as anchored on IOTA"""
+        return {
+            "deviceId": self.device_id,
+            "timestamp": self.isoformat(),
+            "measurements": self.measurements(),
+            "metadata": {
+                "rssi": self.rssi,
+                "snr": self.snr,
+                "frequency": self.frequency,
+                "gateway_id": self.gateway_id
+            }
+        }
+
+    # JSON text of the reading
+    def to_json(self):
+        """JSON text of the reading"""
+        return json.dumps(self.to_dict())
+
+    # UTF-8 JSON bytes of the reading (the bytes that get encrypted and hashed)
+    def to_bytes(self):
+        """UTF-8 JSON bytes of the reading"""
+        return self.to_json().encode()
+
+
+# Average memory per reading of a list of readings built by a factory
+def _bytes_per_reading(factory, count):
+    """Average memory per reading of a list of readings built by a factory"""
+    tracemalloc.start()
+    readings = [factory(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del readings
+    return size / count
+
+
+# Compare the memory of nested-dict and compact readings
+def main():
+    """Compare the memory of nested-dict and compact readings"""
+    parser = argparse.ArgumentParser(description='Measure memory per in-flight reading')
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    def uplink(i):
+        return {
+            'end_device_ids': {'device_id': f"sensor-{i % 50:03d}"},
+            'uplink_message': {
+                'decoded_payload': {'v0': 20 + i % 10 / 10, 'v1': 55.5 + i % 7, 'v2': 18.25 + i % 3, 'v3': i % 1024, 'v4': 40 + i % 20},
+                'rx_metadata': [{'rssi': -70 - i % 30, 'snr': 7.5 + i % 5, 'gateway_ids': {'gateway_id': 'gateway-01'}}],
+                'settings': {'frequency': '868100000'}
+            }
+        }
+
+    uplinks = [uplink(i) for i in range(args.count)]
+    start = time.time()
+    as_dict = _bytes_per_reading(lambda i: SensorReading.from_uplink(uplinks[i], start + i).to_dict(), args.count)
+    compact = _bytes_per_reading(lambda i: SensorReading.from_uplink(uplinks[i], start + i), args.count)
+    print(f"Nested dict reading: {as_dict:.0f} bytes")
+    print(f"SensorReading:       {compact:.0f} bytes ({100 * (1 - compact / as_dict):.0f}% less)")
+    print(f"{args.count} in-flight readings: {as_dict * args.count / 2**20:.1f} MiB -> {compact * args.count / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import json
+import math
+import threading
+import time
+from urllib.parse import unquote
+
+import numpy as np
+
+from reading import CHANNELS
+
+
+# Fixed-size ring of the last readings of one device, one column per channel
+class DeviceRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)  # Capture time, epoch seconds
+        self.values = np.full((capacity, len(CHANNELS)), np.nan)  # Missing values stay NaN
+        self.size = 0
+        self._next = 0  # Slot of the next reading
+
+    # Store a reading, overwriting the oldest once full
+    def append(self, timestamp, values):
+        """Store a reading, overwriting the oldest once full"""
+        slot = self._next
+        self.times[slot] = timestamp
+        self.values[slot] = [np.nan if v is None else v for v in values]
+        self._next = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    # Slot of the latest reading
+    def last(self):
+        """Slot of the latest reading"""
+        return (self._next - 1) % self.capacity
+
+    # Times and values captured in [since, until], oldest first
+    def window(self, since=None, until=None):
+        """Times and values captured in [since, until], oldest first"""
+        order = (np.arange(self.size) + (self._next - self.size)) % self.capacity
+        times = self.times[order]
+        mask = np.ones(self.size, dtype=bool)
+        if since is not None:
+            mask &= times >= since
+        if until is not None:
+            mask &= times <= until
+        order = order[mask]
+        return times[mask], self.values[order]
+
+
+# JSON value of a float, with NaN as null
+def _number(value):
+    """JSON value of a float, with NaN as null"""
+    value = float(value)
+    return None if math.isnan(value) else round(value, 4)
+
+
+# Last readings of every device kept in memory for the local query API
+class RecentReadings:
+    def __init__(self, capacity=1024):
+        self.capacity = capacity  # Readings per device, so memory stays bounded
+        self._rings = {}  # device -> DeviceRing
+        self._lock = threading.Lock()
+
+    # Record a reading
+    def record(self, reading):
+        """Record a reading"""
+        with self._lock:
+            ring = self._rings.get(reading.device_id)
+            if ring is None:
+                ring = self._rings[reading.device_id] = DeviceRing(self.capacity)
+            ring.append(reading.timestamp, reading.values)
+
+    # Devices with readings, their count and latest capture time
+    def devices(self):
+        """Devices with readings, their count and latest capture time"""
+        with self._lock:
+            return {
+                device_id: {'count': ring.size, 'last': float(ring.times[ring.last()])}
+                for device_id, ring in self._rings.items()
+            }
+
+    # Latest reading of a device, or None
+    def latest(self, device_id):
+        """Latest reading of a device, or None"""
+        with self._lock:
+            ring = self._rings.get(device_id)
+            if ring is None:
+                return None
+            slot = ring.last()
+            return {
+                'timestamp': float(ring.times[slot]),
+                'measurements': dict(zip(CHANNELS, map(_number, ring.values[slot])))
+            }
+
+    # Readings of a device captured in [since, until], newest last
+    def range(self, device_id, since=None, until=None, limit=None):
+        """Readings of a device captured in [since, until], newest last"""
+        with self._lock:
+            ring = self._rings.get(device_id)
+            if ring is None:
+                return None
+            times, values = ring.window(since, until)
+        if limit:
+            times, values = times[-limit:], values[-limit:]
+        return [
+            {'timestamp': float(t), 'measurements': dict(zip(CHANNELS, map(_number, row)))}
+            for t, row in zip(times, values)
+        ]
+
+    # Count, min, max and mean of each channel over the readings captured in [since, until]
+    def stats(self, device_id, since=None, until=None):
+        """Count, min, max and mean of each channel over the readings captured in [since, until]"""
+        with self._lock:
+            ring = self._rings.get(device_id)
+            if ring is None:
+                return None
+            times, values = ring.window(since, until)
+        present = ~np.isnan(values)
+        counts = present.sum(axis=0)
+        result = {'count': int(len(times)), 'channels': {}}
+        if len(times):
+            result['from'], result['to'] = float(times.min()), float(times.max())
+        for i, channel in enumerate(CHANNELS):
+            if not counts[i]:
+                result['channels'][channel] = {'count': 0, 'min': None, 'max': None, 'mean': None}
+                continue
+            column = values[present[:, i], i]
+            result['channels'][channel] = {
+                'count': int(counts[i]),
+                'min': _number(column.min()),
+                'max': _number(column.max()),
+                'mean': _number(column.mean())
+            }
+        return result
+
+
+# Local JSON API over the recent readings
+#   /api/devices                       devices, reading count and last capture time
+#   /api/devices/<id>                  latest reading
+#   /api/devices/<id>/stats?window=s   per-channel count, min, max and mean (or since=&until=, epoch seconds)
+#   /api/devices/<id>/readings         readings in a time range (since=&until=&limit=)
+class RecentReadingsAPI:
+    def __init__(self, recent):
+        self.recent = recent
+
+    # JSON response
+    @staticmethod
+    def _json(status, body):
+        """JSON response"""
+        return status, 'application/json', json.dumps(body).encode()
+
+    # Time range of a query, from since/until or the last `window` seconds
+    @staticmethod
+    def _range(query):
+        """Time range of a query, from since/until or the last `window` seconds"""
+        if 'window' in query:
+            return time.time() - float(query['window']), None
+        return (float(query['since']) if 'since' in query else None,
+                float(query['until']) if 'until' in query else None)
+
+    # HTTP route handler for /api/devices and the paths below it
+    def handle_request(self, query, path):
+        """HTTP route handler for /api/devices and the paths below it"""
+        if not path:
+            return self._json(200, self.recent.devices())
+        device_id, _, view = path.partition('/')
+        device_id = unquote(device_id)
+        try:
+            if view == '':
+                body = self.recent.latest(device_id)
+            elif view == 'stats':
+                body = self.recent.stats(device_id, *self._range(query))
+            elif view == 'readings':
+                limit = int(query['limit']) if 'limit' in query else None
+                body = self.recent.range(device_id, *self._range(query), limit=limit)
+            else:
+                return self._json(404, {'error': f"unknown view {view}"})
+        except ValueError as e:
+            return self._json(400, {'error': str(e)})
+        if body is None:
+            return self._json(404, {'error': f"no readings for {device_id}"})
+        return self._json(200, body)
+
+    # Register the API on a local server
+    def register(self, server):
+        """Register the API on a local server"""
+        server.add_prefix_route('/api/devices', self.handle_request)
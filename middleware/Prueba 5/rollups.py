@@ -0,0 +1,194 @@
+import csv
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+from reading import CHANNELS
+
+log = logging.getLogger('middleware.rollups')
+
+# Rollup resolutions: bucket width in seconds and the date format of their files (one file per day or month)
+RESOLUTIONS = {
+    'minute': (60, '%Y-%m-%d'),
+    'hour': (3600, '%Y-%m')
+}
+FIELDS = ('start', 'device_id', 'channel', 'count', 'min', 'max', 'mean', 'last', 'last_time')
+
+
+# Count, min, max, sum and last value of one channel in one bucket
+class Aggregate:
+    __slots__ = ('count', 'min', 'max', 'total', 'last', 'last_time')
+
+    def __init__(self):
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.total = 0.0
+        self.last = None
+        self.last_time = float('-inf')
+
+    # Add one value
+    def add(self, value, timestamp):
+        """Add one value"""
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.total += value
+        if timestamp >= self.last_time:
+            self.last, self.last_time = value, timestamp
+
+    # Add another aggregate of the same bucket (e.g. a row written before a restart)
+    def merge(self, other):
+        """Add another aggregate of the same bucket"""
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.total += other.total
+        if other.last_time >= self.last_time:
+            self.last, self.last_time = other.last, other.last_time
+
+    # Aggregate of a stored row
+    @classmethod
+    def from_row(cls, row):
+        """Aggregate of a stored row"""
+        aggregate = cls()
+        aggregate.count = int(row['count'])
+        aggregate.min = float(row['min'])
+        aggregate.max = float(row['max'])
+        aggregate.total = float(row['mean']) * aggregate.count
+        aggregate.last = float(row['last'])
+        aggregate.last_time = float(row['last_time'])
+        return aggregate
+
+    # Statistics of the bucket
+    def to_dict(self):
+        """Statistics of the bucket"""
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.total / self.count, 6),
+            'last': self.last,
+            'last_time': self.last_time
+        }
+
+
+# Per-device, per-channel minute and hour rollups maintained as readings arrive
+class Rollups:
+    def __init__(self, directory='rollups'):
+        self.directory = Path(directory)
+        self._open = {name: {} for name in RESOLUTIONS}  # resolution -> {(start, device, channel): Aggregate}
+        self._latest = {name: 0 for name in RESOLUTIONS}  # Newest bucket start seen per resolution
+        self._lock = threading.Lock()
+        for name in RESOLUTIONS:
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+
+    # Add a reading to the current bucket of every resolution
+    def add(self, reading):
+        """Add a reading to the current bucket of every resolution"""
+        with self._lock:
+            for name, (width, _) in RESOLUTIONS.items():
+                start = int(reading.timestamp // width * width)
+                if start > self._latest[name]:
+                    # A new bucket started: the older ones are complete and go to disk
+                    self._write(name, [key for key in self._open[name] if key[0] < start])
+                    self._latest[name] = start
+                buckets = self._open[name]
+                for channel, value in zip(CHANNELS, reading.values):
+                    if value is None:
+                        continue
+                    key = (start, reading.device_id, channel)
+                    aggregate = buckets.get(key)
+                    if aggregate is None:
+                        aggregate = buckets[key] = Aggregate()
+                    aggregate.add(value, reading.timestamp)
+
+    # Write every open bucket, e.g. on shutdown (a restart appends to them and queries merge both rows)
+    def flush(self):
+        """Write every open bucket"""
+        with self._lock:
+            for name in RESOLUTIONS:
+                self._write(name, list(self._open[name]))
+
+    # Append buckets to their files and drop them from memory
+    def _write(self, name, keys):
+        """Append buckets to their files and drop them from memory"""
+        if not keys:
+            return
+        by_file = {}
+        for key in sorted(keys):
+            by_file.setdefault(self._partition(name, key[0]), []).append(key)
+        try:
+            for partition, file_keys in by_file.items():
+                path = self.directory / name / f"{partition}.csv"
+                new_file = not path.exists()
+                with path.open('a', newline='') as f:
+                    writer = csv.writer(f)
+                    if new_file:
+                        writer.writerow(FIELDS)
+                    for key in file_keys:
+                        aggregate = self._open[name].pop(key)
+                        stats = aggregate.to_dict()
+                        writer.writerow([*key, *(stats[field] for field in FIELDS[3:])])
+        except Exception as e:
+            log.error("Error writing %s rollups: %s", name, e)
+
+    # File (day or month, UTC) holding a bucket
+    @staticmethod
+    def _partition(name, start):
+        """File (day or month, UTC) holding a bucket"""
+        return datetime.fromtimestamp(start, timezone.utc).strftime(RESOLUTIONS[name][1])
+
+    # Buckets of one resolution in [since, until], from disk and memory, oldest first
+    def query(self, resolution='hour', device_id=None, channel=None, since=None, until=None):
+        """Buckets of one resolution in [since, until], from disk and memory, oldest first"""
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"unknown resolution {resolution}")
+
+        width = RESOLUTIONS[resolution][0]
+
+        def wanted(start, device, chan):
+            return ((since is None or start + width > since)
+                    and (until is None or start <= until)
+                    and (device_id is None or device == device_id)
+                    and (channel is None or chan == channel))
+
+        merged = {}
+        # Only the files whose day or month overlaps the range are read
+        first = self._partition(resolution, since) if since is not None else ''
+        last = self._partition(resolution, until) if until is not None else '~'
+        for path in sorted((self.directory / resolution).glob('*.csv')):
+            if not first <= path.stem <= last:
+                continue
+            with path.open('r', newline='') as f:
+                for row in csv.DictReader(f):
+                    key = (int(row['start']), row['device_id'], row['channel'])
+                    if wanted(*key):
+                        aggregate = Aggregate.from_row(row)
+                        if key in merged:
+                            merged[key].merge(aggregate)
+                        else:
+                            merged[key] = aggregate
+        with self._lock:
+            for key, aggregate in self._open[resolution].items():
+                if wanted(*key):
+                    merged.setdefault(key, Aggregate()).merge(aggregate)
+        return [
+            {'start': start, 'device_id': device, 'channel': chan, **merged[(start, device, chan)].to_dict()}
+            for start, device, chan in sorted(merged)
+        ]
+
+    # HTTP route handler for /api/rollups (resolution=, device=, channel=, since=, until= in epoch seconds)
+    def handle_request(self, query):
+        """HTTP route handler for /api/rollups"""
+        try:
+            buckets = self.query(
+                query.get('resolution', 'hour'), query.get('device'), query.get('channel'),
+                float(query['since']) if 'since' in query else None,
+                float(query['until']) if 'until' in query else None
+            )
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        return 200, 'application/json', json.dumps(buckets).encode()
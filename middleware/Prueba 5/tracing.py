@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import queue
+import random
+import time
+from threading import Thread
+
+import requests
+
+log = logging.getLogger('middleware.tracing')
+
+
+# Timed operation inside a trace
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'attributes')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.end_ns = None
+        self.start_ns = time.monotonic_ns()
+
+    # Add an attribute to the span
+    def set_attribute(self, key, value):
+        """Add an attribute to the span"""
+        self.attributes[key] = value
+
+    # Close the span
+    def end(self):
+        """Close the span"""
+        if self.end_ns is None:
+            self.end_ns = time.monotonic_ns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attributes['error'] = str(exc)
+        self.end()
+        return False
+
+
+# All spans recorded for one uplink message
+class Trace:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.root = Span(self, name, None, attributes)
+        self.spans.append(self.root)
+
+    # Open a child span of the root span
+    def span(self, name, **attributes):
+        """Open a child span of the root span"""
+        span = Span(self, name, self.root.span_id, attributes)
+        self.spans.append(span)
+        return span
+
+    # Add an attribute to the root span
+    def set_attribute(self, key, value):
+        """Add an attribute to the root span"""
+        self.root.attributes[key] = value
+
+    # Close the root span and hand the trace to the exporter
+    def finish(self, **attributes):
+        """Close the root span and hand the trace to the exporter"""
+        self.root.attributes.update(attributes)
+        self.root.end()
+        self.tracer.export(self)
+
+
+# Span that records nothing, used for unsampled messages
+class _NoopSpan:
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+# Trace that records nothing, used for unsampled messages
+class _NoopTrace:
+    __slots__ = ()
+    trace_id = None
+
+    def span(self, name, **attributes):
+        return NOOP_SPAN
+
+    def set_attribute(self, key, value):
+        pass
+
+    def finish(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+NOOP_TRACE = _NoopTrace()
+
+
+# Convert a finished trace to OTLP/JSON span dicts
+def _otlp_spans(trace, epoch_offset_ns):
+    """Convert a finished trace to OTLP/JSON span dicts"""
+    spans = []
+    for span in trace.spans:
+        end_ns = span.end_ns if span.end_ns is not None else span.start_ns
+        spans.append({
+            'traceId': trace.trace_id,
+            'spanId': span.span_id,
+            'parentSpanId': span.parent_id or '',
+            'name': span.name,
+            'startTimeUnixNano': str(span.start_ns + epoch_offset_ns),
+            'endTimeUnixNano': str(end_ns + epoch_offset_ns),
+            'durationMs': round((end_ns - span.start_ns) / 1e6, 3),
+            'attributes': [
+                {'key': key, 'value': {'stringValue': str(value)}}
+                for key, value in span.attributes.items()
+            ]
+        })
+    return spans
+
+
+# Write spans as JSON lines to a local file
+class FileSpanExporter:
+    def __init__(self, path):
+        self.path = path
+
+    # Export a batch of spans
+    def export(self, spans):
+        """Export a batch of spans"""
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span) + '\n')
+
+
+# Send spans to an OTLP/HTTP JSON collector
+class OTLPHttpExporter:
+    def __init__(self, endpoint, service_name='ttn-iota-middleware'):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+
+    # Export a batch of spans
+    def export(self, spans):
+        """Export a batch of spans"""
+        for span in spans:
+            span.pop('durationMs', None)
+        body = {
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': self.service_name}}
+                ]},
+                'scopeSpans': [{'scope': {'name': 'middleware'}, 'spans': spans}]
+            }]
+        }
+        requests.post(self.url, json=body, timeout=5)
+
+
+# Sampling tracer with a background exporter
+class Tracer:
+    def __init__(self, exporter, sample_rate=1.0, max_queue=1000, batch_size=100):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Spans are timed with the monotonic clock and converted to wall time on export
+        self._epoch_offset_ns = time.time_ns() - time.monotonic_ns()
+        Thread(target=self._export_loop, daemon=True).start()
+
+    # Start a trace for one message, or a no-op trace when not sampled
+    def start_trace(self, name, **attributes):
+        """Start a trace for one message, or a no-op trace when not sampled"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_TRACE
+        return Trace(self, name, attributes)
+
+    # Queue a finished trace without blocking the caller
+    def export(self, trace):
+        """Queue a finished trace without blocking the caller"""
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    # Export queued traces in batches
+    def _export_loop(self):
+        """Export queued traces in batches"""
+        while True:
+            traces = [self._queue.get()]
+            while len(traces) < self.batch_size:
+                try:
+                    traces.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                spans = []
+                for trace in traces:
+                    spans.extend(_otlp_spans(trace, self._epoch_offset_ns))
+                self.exporter.export(spans)
+            except Exception as e:
+                log.error("Error exporting traces: %s", e)
+            finally:
+                for _ in traces:
+                    self._queue.task_done()
+
+    # Wait until the queued traces are exported, up to a timeout
+    def flush(self, timeout=5.0):
+        """Wait until the queued traces are exported, up to a timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
@@ -0,0 +1,254 @@
+import argparse
+import json
+import math
+import struct
+import time
+
+import numpy as np
+
+from reading import CHANNELS, SensorReading
+
+# Series layout: magic, version, channel count, timestamp units per second, reading count, then the bit stream
+MAGIC = b'TSZ'
+VERSION = 1
+HEADER = struct.Struct('>3sBBHI')
+
+# Delta-of-delta buckets: (control bits, control length, value bits), tried in order
+DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32), (0b11111, 5, 64))
+NAN_BITS = struct.unpack('>Q', struct.pack('>d', math.nan))[0]
+
+
+# Writes values of any bit width into a byte string
+class BitWriter:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._acc = 0  # Bits not yet written to the buffer
+        self._bits = 0
+
+    # Append the low `nbits` bits of a value
+    def write(self, value, nbits):
+        """Append the low `nbits` bits of a value"""
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._bits += nbits
+        if self._bits >= 8:
+            whole = self._bits // 8
+            self._bits -= whole * 8
+            self._buffer += (self._acc >> self._bits).to_bytes(whole, 'big')
+            self._acc &= (1 << self._bits) - 1
+
+    # Bytes written so far, the last one padded with zeros
+    def to_bytes(self):
+        """Bytes written so far, the last one padded with zeros"""
+        if not self._bits:
+            return bytes(self._buffer)
+        return bytes(self._buffer) + bytes([(self._acc << (8 - self._bits)) & 0xFF])
+
+
+# Reads values of any bit width from a byte string
+class BitReader:
+    def __init__(self, data, position=0):
+        # The stream is expanded once into a string of '0'/'1', so each read is a C-level slice and parse
+        self._bits = format(int.from_bytes(data, 'big'), f"0{len(data) * 8}b") if data else ''
+        self.position = position  # In bits
+
+    # Next `nbits` bits as an unsigned integer
+    def read(self, nbits):
+        """Next `nbits` bits as an unsigned integer"""
+        end = self.position + nbits
+        if end > len(self._bits):
+            raise ValueError("Truncated series")
+        value = int(self._bits[self.position:end], 2)
+        self.position = end
+        return value
+
+    # Number of consecutive 1 bits before the next 0 (which is consumed), up to a limit
+    def ones(self, limit):
+        """Number of consecutive 1 bits before the next 0, up to a limit"""
+        zero = self._bits.find('0', self.position, self.position + limit)
+        if zero < 0:
+            if self.position + limit > len(self._bits):
+                raise ValueError("Truncated series")
+            self.position += limit
+            return limit
+        count = zero - self.position
+        self.position = zero + 1
+        return count
+
+
+# Bits of a float as an unsigned 64-bit integer (None is stored as NaN)
+def _float_bits(value):
+    """Bits of a float as an unsigned 64-bit integer"""
+    return NAN_BITS if value is None else struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+# Write timestamps (integer units) as a first value and the deltas of their deltas
+def _write_timestamps(writer, ticks):
+    """Write timestamps (integer units) as a first value and the deltas of their deltas"""
+    writer.write(ticks[0], 64)
+    previous_delta = 0
+    for previous, tick in zip(ticks, ticks[1:]):
+        delta = tick - previous
+        dod = delta - previous_delta
+        previous_delta = delta
+        if dod == 0:
+            writer.write(0, 1)  # Regular interval: one bit
+            continue
+        for control, control_bits, value_bits in DOD_BUCKETS:
+            if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                writer.write(control, control_bits)
+                writer.write(dod, value_bits)
+                break
+
+
+# Write floats XORed with the previous one, reusing the previous leading/trailing zero window when it fits
+def _write_floats(writer, values):
+    """Write floats XORed with the previous one"""
+    previous = _float_bits(values[0])
+    writer.write(previous, 64)
+    leading, trailing = -1, 0  # No window yet
+    for value in values[1:]:
+        bits = _float_bits(value)
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)  # Unchanged value: one bit
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading >= 0 and new_leading >= leading and new_trailing >= trailing:
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 63, 6)  # 64 meaningful bits are stored as 0
+            writer.write(xor >> trailing, meaningful)
+
+
+# Encode one device stream: timestamps (epoch seconds) and one value sequence per channel
+def encode_series(timestamps, columns, resolution=1000):
+    """Encode one device stream: timestamps (epoch seconds) and one value sequence per channel"""
+    if not len(timestamps):
+        raise ValueError("Cannot encode an empty series")
+    ticks = [round(t * resolution) for t in timestamps]
+    writer = BitWriter()
+    _write_timestamps(writer, ticks)
+    for column in columns:
+        _write_floats(writer, list(column))
+    return HEADER.pack(MAGIC, VERSION, len(columns), resolution, len(ticks)) + writer.to_bytes()
+
+
+# Signed value of a two's complement field
+def _signed(value, nbits):
+    """Signed value of a two's complement field"""
+    return value - (1 << nbits) if value >= 1 << (nbits - 1) else value
+
+
+# Decode a series into timestamps (epoch seconds) and a (readings x channels) value matrix
+def decode_series(data):
+    """Decode a series into timestamps (epoch seconds) and a (readings x channels) value matrix"""
+    magic, version, channel_count, resolution, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a TSZ series")
+    reader = BitReader(data, HEADER.size * 8)
+
+    # The bit stream is read sequentially into plain lists; the running sums and XORs are then rebuilt with NumPy
+    read, ones = reader.read, reader.ones
+    first = _signed(read(64), 64)
+    dods = [0] * count
+    for i in range(1, count):
+        bucket = ones(5)
+        if bucket:
+            value_bits = DOD_BUCKETS[bucket - 1][2]
+            dods[i] = _signed(read(value_bits), value_bits)
+    ticks = first + np.cumsum(np.cumsum(np.array(dods, dtype=np.int64)))
+    timestamps = ticks / resolution
+
+    values = np.empty((count, channel_count))
+    for channel in range(channel_count):
+        xors = [0] * count
+        xors[0] = read(64)
+        leading = trailing = 0
+        for i in range(1, count):
+            control = ones(2)
+            if not control:
+                continue
+            if control == 2:
+                leading = read(5)
+                meaningful = read(6) or 64
+                trailing = 64 - leading - meaningful
+            xors[i] = read(64 - leading - trailing) << trailing
+        values[:, channel] = np.bitwise_xor.accumulate(np.array(xors, dtype=np.uint64)).view(np.float64)
+    return timestamps, values
+
+
+# Encode readings as one series per device, in capture order
+def encode_readings(readings, resolution=1000):
+    """Encode readings as one series per device, in capture order"""
+    by_device = {}
+    for reading in sorted(readings, key=lambda r: r.timestamp):
+        by_device.setdefault(reading.device_id, []).append(reading)
+    return {
+        device_id: encode_series(
+            [r.timestamp for r in device_readings],
+            list(zip(*(r.values for r in device_readings))),
+            resolution)
+        for device_id, device_readings in by_device.items()
+    }
+
+
+# Readings of an encoded device series (NaN values become None)
+def decode_readings(device_id, data):
+    """Readings of an encoded device series"""
+    timestamps, values = decode_series(data)
+    return [
+        SensorReading(device_id, float(t), tuple(None if math.isnan(v) else float(v) for v in row))
+        for t, row in zip(timestamps, values)
+    ]
+
+
+# Compare the codec with JSON readings on a synthetic slowly varying stream
+def main():
+    """Compare the codec with JSON readings on a synthetic slowly varying stream"""
+    parser = argparse.ArgumentParser(description='Delta-of-delta / XOR series codec benchmark')
+    parser.add_argument('--readings', type=int, default=10000, help='Readings per device')
+    parser.add_argument('--interval', type=float, default=38.0, help='Seconds between readings')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    start = time.time()
+    readings = []
+    temperature, humidity, soil = 17.0, 70.0, 33.0
+    for i in range(args.readings):
+        temperature = round(temperature + rng.normal(0, 0.05), 2)
+        humidity = round(humidity + rng.normal(0, 0.1), 2)
+        readings.append(SensorReading(
+            'device-esp32-tfe', start + i * args.interval + rng.uniform(-0.2, 0.2),
+            (temperature, humidity, round(temperature - 3, 2), 0.0, soil)))
+
+    json_bytes = sum(len(r.to_bytes()) for r in readings)
+    csv_like = sum(len(f"{r.isoformat()}," + ','.join(map(str, r.values))) + 1 for r in readings)
+    t0 = time.perf_counter()
+    encoded = encode_readings(readings)['device-esp32-tfe']
+    t1 = time.perf_counter()
+    timestamps, values = decode_series(encoded)
+    t2 = time.perf_counter()
+
+    original = np.array([r.values for r in readings])
+    assert np.array_equal(values, original), "Decoded values differ"
+    assert np.allclose(timestamps, [r.timestamp for r in readings], atol=1e-3), "Decoded timestamps differ"
+    print(json.dumps({
+        'readings': args.readings,
+        'json_bytes_per_reading': round(json_bytes / args.readings, 1),
+        'csv_bytes_per_reading': round(csv_like / args.readings, 1),
+        'codec_bytes_per_reading': round(len(encoded) / args.readings, 2),
+        'bits_per_value': round(len(encoded) * 8 / args.readings / (len(CHANNELS) + 1), 2),
+        'encode_us_per_reading': round((t1 - t0) / args.readings * 1e6, 2),
+        'decode_us_per_reading': round((t2 - t1) / args.readings * 1e6, 2)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
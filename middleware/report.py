@@ -0,0 +1,258 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Columns that are not sensor channels in the transaction CSVs
+TRANSACTION_FIELDS = {
+    'Block ID', 'Device ID', 'Timestamp', 'TTN time', 'Confirmation time',
+    'Response time', 'Explorer URL', 'Confirmed'
+}
+METRIC_FIELDS = {
+    'Timestamp': 'timestamp',
+    'Operation': 'operation',
+    'Original size (bytes)': 'original_size',
+    'Encrypted size (bytes)': 'encrypted_size',
+    'Encryption time (s)': 'encryption_time',
+    'Transmission time (s)': 'transmission_time',
+    'Total time (s)': 'total_time'
+}
+PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+CONFIRMATION_FIELDS = {'Block ID', 'Confirmation time', 'Response time'}  # iota_confirmations.csv
+
+
+# Name a run after its test directory and file
+def run_name(path):
+    """Name a run after its test directory and file"""
+    return f"{path.parent.name}/{path.stem}"
+
+
+# Load a transaction CSV (iota_data*.csv, decryptData.csv) into the common layout
+def load_transactions(path, header):
+    """Load a transaction CSV into the common layout"""
+    channels = [c for c in header if c not in TRANSACTION_FIELDS]
+    df = pd.read_csv(
+        path,
+        usecols=['Block ID', 'Device ID', 'TTN time', 'Confirmation time', 'Response time', 'Confirmed'],
+        dtype={'Block ID': str, 'Device ID': 'category', 'TTN time': str, 'Confirmation time': str}
+    )
+    transactions = pd.DataFrame({
+        'run': pd.Categorical([run_name(path)] * len(df)),
+        'device_id': df['Device ID'],
+        'ttn_time': pd.to_datetime(df['TTN time'], format='ISO8601', errors='coerce'),
+        'confirmation_time': pd.to_datetime(df['Confirmation time'], format='ISO8601', errors='coerce'),
+        'response_time': pd.to_numeric(df['Response time'], errors='coerce'),
+        'confirmed': df['Confirmed'].astype(str).str.lower().eq('true'),
+        'channels': np.int16(len(channels))
+    })
+    # Newer runs append confirmations to iota_confirmations.csv next to iota_data.csv
+    confirmations_path = path.with_name(path.name.replace('iota_data', 'iota_confirmations'))
+    if confirmations_path != path and confirmations_path.exists():
+        confirmations = pd.read_csv(confirmations_path, dtype={'Block ID': str, 'Confirmation time': str})
+        confirmations = confirmations.drop_duplicates('Block ID', keep='last').set_index('Block ID')
+        confirmed = pd.to_datetime(
+            df['Block ID'].map(confirmations['Confirmation time']), format='ISO8601', errors='coerce')
+        # Rows anchored together (Merkle batches) each get their own response time, from their TTN time
+        transactions['response_time'] = (
+            (confirmed - transactions['ttn_time']).dt.total_seconds().fillna(transactions['response_time']))
+        transactions['confirmation_time'] = confirmed.combine_first(transactions['confirmation_time'])
+        transactions['confirmed'] |= confirmed.notna()
+    return transactions
+
+
+# Load an encryption_metrics.csv into the common layout
+def load_metrics(path, header):
+    """Load an encryption_metrics.csv into the common layout"""
+    df = pd.read_csv(path, usecols=list(METRIC_FIELDS), dtype={'Operation': 'category'})
+    df = df.rename(columns=METRIC_FIELDS)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce')
+    df.insert(0, 'run', pd.Categorical([run_name(path)] * len(df)))
+    return df
+
+
+# Load every recognised run file into two columnar tables
+def load_runs(paths):
+    """Load every recognised run file into two columnar tables"""
+    transactions, metrics = [], []
+    for path in paths:
+        header = pd.read_csv(path, nrows=0).columns.tolist()
+        if {'Block ID', 'TTN time', 'Response time'} <= set(header):
+            transactions.append(load_transactions(path, header))
+        elif set(METRIC_FIELDS) <= set(header):
+            metrics.append(load_metrics(path, header))
+        elif set(header) == CONFIRMATION_FIELDS:
+            continue  # Merged into the iota_data file next to it
+        else:
+            print(f"Skipping {path}: unrecognised layout")
+    transactions = pd.concat(transactions, ignore_index=True) if transactions else pd.DataFrame()
+    metrics = pd.concat(metrics, ignore_index=True) if metrics else pd.DataFrame()
+    for df in (transactions, metrics):
+        if not df.empty:
+            df['run'] = df['run'].astype('category')
+    return transactions, metrics
+
+
+# Percentile columns of a value per group
+def group_percentiles(df, by, column, prefix):
+    """Percentile columns of a value per group"""
+    q = df.groupby(by, observed=True)[column].quantile(list(PERCENTILES)).unstack()
+    q.columns = [f"{prefix}_p{int(p * 100)}" for p in q.columns]
+    return q
+
+
+# Latency and throughput statistics per run
+def latency_report(transactions):
+    """Latency and throughput statistics per run"""
+    if transactions.empty:
+        return pd.DataFrame()
+    grouped = transactions.groupby('run', observed=True)
+    summary = grouped.agg(
+        messages=('response_time', 'size'),
+        confirmed=('confirmed', 'sum'),
+        devices=('device_id', 'nunique'),
+        channels=('channels', 'max'),
+        latency_mean=('response_time', 'mean'),
+        latency_max=('response_time', 'max'),
+        first=('ttn_time', 'min'),
+        last=('ttn_time', 'max')
+    )
+    duration = (summary['last'] - summary['first']).dt.total_seconds()
+    summary['duration_s'] = duration
+    summary['throughput_per_min'] = np.where(duration > 0, summary['messages'] / duration * 60, np.nan)
+    summary['confirmed_ratio'] = summary['confirmed'] / summary['messages']
+    summary = summary.join(group_percentiles(transactions, 'run', 'response_time', 'latency'))
+    return summary.drop(columns=['first', 'last'])
+
+
+# Payload size and crypto overhead statistics per run and operation
+def crypto_report(metrics):
+    """Payload size and crypto overhead statistics per run and operation"""
+    if metrics.empty:
+        return pd.DataFrame()
+    metrics = metrics.assign(
+        size_overhead=metrics['encrypted_size'] / metrics['original_size'],
+        crypto_share=np.where(metrics['total_time'] > 0,
+                              metrics['encryption_time'] / metrics['total_time'], np.nan)
+    )
+    by = ['run', 'operation']
+    summary = metrics.groupby(by, observed=True).agg(
+        count=('original_size', 'size'),
+        original_size_mean=('original_size', 'mean'),
+        encrypted_size_mean=('encrypted_size', 'mean'),
+        size_overhead_mean=('size_overhead', 'mean'),
+        encryption_time_mean=('encryption_time', 'mean'),
+        transmission_time_mean=('transmission_time', 'mean'),
+        crypto_share_mean=('crypto_share', 'mean')
+    )
+    summary = summary.join(group_percentiles(metrics, by, 'encryption_time', 'encryption_time'))
+    return summary.join(group_percentiles(metrics, by, 'transmission_time', 'transmission_time'))
+
+
+# Load the hour rollups written by the middleware (rollups/hour/*.csv), merging rows of the same bucket
+def load_rollups(directories, resolution='hour'):
+    """Load the hour rollups written by the middleware, merging rows of the same bucket"""
+    paths = [p for d in directories for p in sorted((Path(d) / resolution).glob('*.csv'))]
+    if not paths:
+        return pd.DataFrame()
+    df = pd.concat(
+        (pd.read_csv(p, dtype={'device_id': 'category', 'channel': 'category'}) for p in paths),
+        ignore_index=True
+    )
+    # A bucket written before a restart and completed after it has two rows
+    df['total'] = df['mean'] * df['count']
+    df = df.sort_values('last_time')
+    return df.groupby(['start', 'device_id', 'channel'], observed=True).agg(
+        count=('count', 'sum'), min=('min', 'min'), max=('max', 'max'),
+        total=('total', 'sum'), last=('last', 'last')
+    ).reset_index()
+
+
+# Sensor statistics per device and channel, from the rollups instead of the raw readings
+def sensor_report(rollups):
+    """Sensor statistics per device and channel, from the rollups instead of the raw readings"""
+    if rollups.empty:
+        return pd.DataFrame()
+    ordered = rollups.sort_values('start')
+    summary = ordered.groupby(['device_id', 'channel'], observed=True).agg(
+        readings=('count', 'sum'), min=('min', 'min'), max=('max', 'max'),
+        total=('total', 'sum'), last=('last', 'last'), first_hour=('start', 'min'), last_hour=('start', 'max')
+    )
+    summary['mean'] = summary['total'] / summary['readings']
+    for column in ('first_hour', 'last_hour'):
+        summary[column] = pd.to_datetime(summary[column], unit='s', utc=True)
+    return summary.drop(columns=['total'])
+
+
+# Expand directories into the CSV files they contain
+def expand_paths(inputs):
+    """Expand directories into the CSV files they contain"""
+    paths = []
+    for item in inputs:
+        path = Path(item)
+        paths.extend(sorted(path.rglob('*.csv')) if path.is_dir() else [path])
+    return paths
+
+
+# Write the comparative report as JSON
+def write_json(path, latency, crypto, sensors):
+    """Write the comparative report as JSON"""
+    report = {
+        'latency': json.loads(latency.reset_index().to_json(orient='records')),
+        'crypto': json.loads(crypto.reset_index().to_json(orient='records'))
+    }
+    if not sensors.empty:
+        report['sensors'] = json.loads(sensors.reset_index().to_json(orient='records', date_format='iso'))
+    Path(path).write_text(json.dumps(report, indent=2))
+
+
+# Write the comparative report as HTML
+def write_html(path, latency, crypto, sensors):
+    """Write the comparative report as HTML"""
+    sections = [
+        ('Response time and throughput per run', latency),
+        ('Payload size and encryption overhead per run', crypto)
+    ]
+    if not sensors.empty:
+        sections.append(('Sensor readings per device and channel (hour rollups)', sensors))
+    body = ''.join(
+        f"<h2>{title}</h2>" + (table.to_html(float_format=lambda v: f"{v:.4g}") if not table.empty
+                               else "<p>No data</p>")
+        for title, table in sections
+    )
+    Path(path).write_text(
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Run comparison</title>"
+        "<style>body{font-family:sans-serif}table{border-collapse:collapse}"
+        "td,th{border:1px solid #ccc;padding:3px 8px;text-align:right}</style></head>"
+        f"<body><h1>TTN to Tangle: run comparison</h1>{body}</body></html>"
+    )
+
+
+# Main entry point
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Comparative report over middleware test runs')
+    parser.add_argument('inputs', nargs='+', help='CSV files or directories (e.g. "Prueba 3" "Prueba 5")')
+    parser.add_argument('--json', default='report.json', help='JSON output file')
+    parser.add_argument('--html', default='report.html', help='HTML output file')
+    parser.add_argument('--rollups', nargs='*', default=[],
+                        help='Rollup directories of the middleware (e.g. "Prueba 5/rollups") for sensor statistics')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    transactions, metrics = load_runs(expand_paths(args.inputs))
+    loaded = time.perf_counter()
+    latency = latency_report(transactions)
+    crypto = crypto_report(metrics)
+    sensors = sensor_report(load_rollups(args.rollups))
+    write_json(args.json, latency, crypto, sensors)
+    write_html(args.html, latency, crypto, sensors)
+    print(f"Loaded {len(transactions)} transactions and {len(metrics)} metric rows "
+          f"in {loaded - start:.2f}s, report built in {time.perf_counter() - loaded:.2f}s")
+    print(f"Report written to {args.json} and {args.html}")
+
+
+if __name__ == "__main__":
+    main()